@@ -0,0 +1,520 @@
+"""Events from local .ics files for the calendar screen.
+
+Files are parsed line by line, and on refresh only files whose mtime or
+size changed are parsed again. Recurring events are expanded over a window
+covering the current month and the next few weeks into one list sorted by
+start time, so the next events and a day's events are bisect lookups.
+refresh() blocks and is meant for a worker thread; readers on the event
+loop see either the old index or the new one, never a mix.
+"""
+import asyncio
+import bisect
+import calendar
+import logging
+import os
+import re
+import traceback
+from datetime import date, datetime, time, timedelta, timezone
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:  # before Python 3.9 TZID times are taken as local
+    ZoneInfo = None
+
+WEEKDAYS = {'MO': 0, 'TU': 1, 'WE': 2, 'TH': 3, 'FR': 4, 'SA': 5, 'SU': 6}
+DURATION_RE = re.compile(r'([+-])?P(?:(\d+)W)?(?:(\d+)D)?'
+                         r'(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?')
+BYDAY_RE = re.compile(r'([+-]?\d{1,2})?(MO|TU|WE|TH|FR|SA|SU)')
+FREQS = ('DAILY', 'WEEKLY', 'MONTHLY', 'YEARLY')
+RULE_PARTS = {'FREQ', 'INTERVAL', 'COUNT', 'UNTIL', 'WKST',
+              'BYDAY', 'BYMONTH', 'BYMONTHDAY'}
+EMPTY_PERIODS = 400  # periods in a row without a date before a rule is dropped
+
+
+class Event:
+    def __init__(self):
+        self.uid = None
+        self.summary = ''
+        self.start = None
+        self.end = None
+        self.duration = None
+        self.all_day = False
+        self.rrule = None
+        self.exdates = set()
+        self.recurrence_id = None
+
+
+def unfold(lines):
+    """Join RFC 5545 folded lines, yielding one logical line at a time"""
+    current = None
+    for line in lines:
+        line = line.rstrip('\r\n')
+        if line[:1] in (' ', '\t'):
+            if current is not None:
+                current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current is not None:
+        yield current
+
+
+def split_property(line):
+    """'DTSTART;TZID=X:20260101T090000' -> ('DTSTART', {'TZID': 'X'}, value)"""
+    head, _, value = line.partition(':')
+    name, *params = head.split(';')
+    return (name.upper(),
+            dict(param.split('=', 1) for param in params if '=' in param),
+            value)
+
+
+def parse_datetime(value, params):
+    """Datetime and whether it is an all-day DATE value.
+
+    UTC and TZID times come back aware, so recurrences can be stepped in
+    their own zone across DST changes; floating times and dates are naive.
+    """
+    value = value.strip()
+    if params.get('VALUE') == 'DATE' or len(value) == 8:
+        return datetime.strptime(value[:8], '%Y%m%d'), True
+    dt = datetime.strptime(value[:15], '%Y%m%dT%H%M%S')
+    if value.endswith('Z'):
+        dt = dt.replace(tzinfo=timezone.utc)
+    elif 'TZID' in params and ZoneInfo is not None:
+        try:
+            dt = dt.replace(tzinfo=ZoneInfo(params['TZID'].strip('"')))
+        except (KeyError, ValueError):
+            pass  # unknown zone name, e.g. from Outlook, taken as local
+    return dt, False
+
+
+def to_local(dt):
+    """Naive local time, the form the index is kept in"""
+    if dt.tzinfo is None:
+        return dt
+    return dt.astimezone().replace(tzinfo=None)
+
+
+def parse_duration(value):
+    match = DURATION_RE.fullmatch(value.strip())
+    if match is None:
+        return None
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = timedelta(weeks=int(weeks or 0), days=int(days or 0),
+                         hours=int(hours or 0), minutes=int(minutes or 0),
+                         seconds=int(seconds or 0))
+    return -duration if sign == '-' else duration
+
+
+def unescape(text):
+    return (text.replace('\\n', ' ').replace('\\N', ' ').replace('\\,', ',')
+            .replace('\\;', ';').replace('\\\\', '\\'))
+
+
+def parse_ics(lines):
+    """VEVENTs from an iterable of lines, such as an open file"""
+    events = []
+    event = None
+    depth = 0  # components nested in the event, such as VALARM
+    for line in unfold(lines):
+        if event is None:
+            if line == 'BEGIN:VEVENT':
+                event = Event()
+            continue
+        if line.startswith('BEGIN:'):
+            depth += 1
+        elif line.startswith('END:'):
+            if depth:
+                depth -= 1
+            else:
+                if event.rrule is not None:
+                    problem = rule_problem(event.rrule)
+                    if problem is not None:
+                        # better the first date alone than guessed ones
+                        logging.warning("'%s' repeats by a rule that cannot "
+                                        "be expanded (%s)", event.summary,
+                                        problem)
+                        event.rrule = None
+                if event.start is not None:
+                    if event.end is None:
+                        event.end = event.start + (
+                            event.duration or
+                            timedelta(days=1 if event.all_day else 0))
+                    events.append(event)
+                event = None
+        elif not depth:
+            name, params, value = split_property(line)
+            if name == 'SUMMARY':
+                event.summary = unescape(value)
+            elif name == 'UID':
+                event.uid = value
+            elif name == 'DTSTART':
+                event.start, event.all_day = parse_datetime(value, params)
+            elif name == 'DTEND':
+                event.end = parse_datetime(value, params)[0]
+            elif name == 'DURATION':
+                event.duration = parse_duration(value)
+            elif name == 'RRULE':
+                event.rrule = dict(part.split('=', 1)
+                                   for part in value.split(';') if '=' in part)
+            elif name == 'EXDATE':
+                for item in value.split(','):
+                    event.exdates.add(
+                        to_local(parse_datetime(item, params)[0]))
+            elif name == 'RECURRENCE-ID':
+                event.recurrence_id = to_local(
+                    parse_datetime(value, params)[0])
+    return events
+
+
+def add_months(dt, months):
+    """dt moved by months, None if that month has no such day"""
+    year, month = divmod(dt.month - 1 + months, 12)
+    try:
+        return dt.replace(year=dt.year + year, month=month + 1)
+    except ValueError:
+        return None
+
+
+def nth_weekday(year, month, weekday, n, at):
+    """n-th (negative counts from the end) weekday of a month at time at"""
+    first = date(year, month, 1)
+    if n > 0:
+        day = first + timedelta(days=(weekday - first.weekday()) % 7
+                                + 7 * (n - 1))
+    else:
+        last = (add_months(datetime.combine(first, at), 1).date()
+                - timedelta(days=1))
+        day = last - timedelta(days=(last.weekday() - weekday) % 7
+                               + 7 * (-n - 1))
+    if day.month != month:
+        return None
+    return datetime.combine(day, at)
+
+
+def rule_lists(rule):
+    """BYDAY as (ordinal or 0, weekday) pairs, BYMONTH and BYMONTHDAY.
+
+    The last two are None when the rule has no such part. Raises
+    ValueError on malformed values.
+    """
+    byday = []
+    for day in filter(None, rule.get('BYDAY', '').split(',')):
+        match = BYDAY_RE.fullmatch(day)
+        if match is None:
+            raise ValueError('BYDAY=' + rule['BYDAY'])
+        byday.append((int(match.group(1) or 0), WEEKDAYS[match.group(2)]))
+    bymonth = bymonthday = None
+    if 'BYMONTH' in rule:
+        bymonth = {int(month) for month in rule['BYMONTH'].split(',')}
+    if 'BYMONTHDAY' in rule:
+        bymonthday = [int(day) for day in rule['BYMONTHDAY'].split(',')]
+    return byday, bymonth, bymonthday
+
+
+def rule_problem(rule):
+    """Why recur() cannot expand rule, None if it can"""
+    unknown = set(rule) - RULE_PARTS
+    if unknown:
+        return 'no support for ' + ', '.join(sorted(unknown))
+    freq = rule.get('FREQ')
+    if freq not in FREQS:
+        return 'no support for FREQ=%s' % freq
+    try:
+        int(rule.get('INTERVAL', 1))
+        int(rule.get('COUNT', 0))
+        if 'UNTIL' in rule:
+            parse_datetime(rule['UNTIL'], {})
+        byday, bymonth, bymonthday = rule_lists(rule)
+    except ValueError as e:
+        return 'malformed %s' % e
+    if bymonth is not None and not bymonth <= set(range(1, 13)):
+        return 'BYMONTH=' + rule['BYMONTH']
+    if bymonthday is not None and not all(
+            0 < abs(day) <= 31 for day in bymonthday):
+        return 'BYMONTHDAY=' + rule['BYMONTHDAY']
+    if bymonthday is not None and freq == 'WEEKLY':
+        return 'BYMONTHDAY in a WEEKLY rule'
+    ordinals = [n for n, _ in byday if n]
+    if ordinals:
+        if freq in ('DAILY', 'WEEKLY'):
+            return 'numbered BYDAY in a %s rule' % freq
+        if freq == 'YEARLY' and bymonth is None:
+            return 'numbered BYDAY counted through the year'
+        if not all(0 < abs(n) <= 5 for n in ordinals):
+            return 'BYDAY=' + rule['BYDAY']
+    return None
+
+
+def month_days(year, month, byday, bymonthday, at):
+    """Days of a month in both BYMONTHDAY and BYDAY, at time at.
+
+    Either may be empty or None, meaning no limit from that part.
+    """
+    length = calendar.monthrange(year, month)[1]
+    days = set(range(1, length + 1))
+    if bymonthday is not None:
+        days &= {day if day > 0 else length + 1 + day for day in bymonthday}
+    if byday:
+        matching = set()
+        first = date(year, month, 1).weekday()
+        for n, weekday in byday:
+            if n:
+                occ = nth_weekday(year, month, weekday, n, at)
+                if occ is not None:
+                    matching.add(occ.day)
+            else:
+                matching.update(range((weekday - first) % 7 + 1,
+                                      length + 1, 7))
+        days &= matching
+    return [datetime.combine(date(year, month, day), at)
+            for day in sorted(days)]
+
+
+def recur(start, rule, window_start):
+    """Candidate occurrence starts in order, from the first one.
+
+    rule must have passed rule_problem(). Covers FREQ DAILY, WEEKLY,
+    MONTHLY and YEARLY with BYDAY, BYMONTH and BYMONTHDAY, stepping wall
+    clock time in start's zone. Without COUNT the periods entirely before
+    window_start are skipped. Gives up after EMPTY_PERIODS periods in a
+    row without a date, such as for BYMONTH=2;BYMONTHDAY=30.
+    """
+    if start.tzinfo is not None:
+        window_start = window_start.astimezone(start.tzinfo)
+    freq = rule['FREQ']
+    interval = max(1, int(rule.get('INTERVAL', 1)))
+    skip = 'COUNT' not in rule and start < window_start
+    byday, bymonth, bymonthday = rule_lists(rule)
+    weekdays = {weekday for _, weekday in byday}
+    at = start.timetz()
+    if bymonthday is None and not byday:
+        bymonthday = [start.day]  # MONTHLY and YEARLY default
+
+    def limit(occ):
+        # BYxxx parts narrow down the days DAILY and WEEKLY step through
+        if bymonth is not None and occ.month not in bymonth:
+            return False
+        if weekdays and occ.weekday() not in weekdays:
+            return False
+        if 'BYMONTHDAY' in rule:
+            length = calendar.monthrange(occ.year, occ.month)[1]
+            return any(occ.day == (day if day > 0 else length + 1 + day)
+                       for day in bymonthday)
+        return True
+
+    if freq == 'DAILY':
+        k = (window_start - start).days // interval if skip else 0
+
+        def period(k):
+            occ = start + timedelta(days=k * interval)
+            return [occ] if limit(occ) else []
+    elif freq == 'WEEKLY':
+        week = start - timedelta(days=start.weekday())
+        k = (window_start - week).days // (7 * interval) if skip else 0
+        days = sorted(weekdays or {start.weekday()})
+
+        def period(k):
+            return [occ for occ in (week + timedelta(days=7 * k * interval
+                                                     + weekday)
+                                    for weekday in days) if limit(occ)]
+    elif freq == 'MONTHLY':
+        months = ((window_start.year - start.year) * 12
+                  + window_start.month - start.month)
+        k = max(0, months // interval) if skip else 0
+        first = start.replace(day=1)
+
+        def period(k):
+            month = add_months(first, k * interval)
+            if month is None or (bymonth is not None
+                                 and month.month not in bymonth):
+                return []
+            return month_days(month.year, month.month, byday, bymonthday, at)
+    else:
+        k = 0
+        if skip:
+            k = max(0, (window_start.year - start.year) // interval)
+        if bymonth is not None:
+            months = sorted(bymonth)
+        elif 'BYMONTHDAY' in rule or byday:
+            months = range(1, 13)
+        else:
+            months = [start.month]
+
+        def period(k):
+            year = start.year + k * interval
+            return [occ for month in months
+                    for occ in month_days(year, month, byday, bymonthday, at)]
+
+    empty = 0
+    while empty < EMPTY_PERIODS:
+        try:
+            found = [occ for occ in period(k) if occ >= start]
+        except (ValueError, OverflowError):
+            return  # past the year 9999
+        yield from found
+        empty = 0 if found else empty + 1
+        k += 1
+    logging.warning('no dates from RRULE %s in %d periods, giving up',
+                    ';'.join('%s=%s' % part for part in rule.items()),
+                    EMPTY_PERIODS)
+
+
+def occurrences(event, window_start, window_end, skip=()):
+    """(start, end) of each occurrence overlapping the window"""
+    start, end = to_local(event.start), to_local(event.end)
+    duration = end - start
+    if not event.rrule:
+        if start < window_end and end > window_start:
+            yield start, end
+        return
+
+    until = count = None
+    if 'UNTIL' in event.rrule:
+        until = to_local(parse_datetime(event.rrule['UNTIL'], {})[0])
+        if event.all_day or len(event.rrule['UNTIL']) == 8:
+            until += timedelta(days=1) - timedelta(seconds=1)
+    if 'COUNT' in event.rrule:
+        count = int(event.rrule['COUNT'])
+
+    for n, occ in enumerate(recur(event.start, event.rrule, window_start)):
+        occ = to_local(occ)
+        if ((count is not None and n >= count) or
+                (until is not None and occ > until) or occ >= window_end):
+            return
+        if occ + duration > window_start and occ not in skip:
+            yield occ, occ + duration
+
+
+class Agenda:
+    """Sorted occurrences of every event in a directory of .ics files"""
+
+    def __init__(self, path, horizon=42):
+        self.path = path  # a directory of .ics files, or a single file
+        self.horizon = horizon  # days past today to expand recurrences to
+        self.version = 0
+        self._files = {}
+        self._window = None
+        self._index = ([], [])
+
+    def _paths(self):
+        if os.path.isdir(self.path):
+            return [entry.path for entry in os.scandir(self.path)
+                    if entry.name.lower().endswith('.ics')]
+        return [self.path] if os.path.exists(self.path) else []
+
+    def window(self, today):
+        first = datetime(today.year, today.month, 1)
+        next_month = add_months(first, 1)
+        horizon = datetime.combine(today, time()) + timedelta(self.horizon)
+        return first, max(next_month, horizon)
+
+    def refresh(self, today=None):
+        """Parse changed files and rebuild the index if anything changed.
+
+        Blocking, run it in an executor. Returns True if the index changed.
+        """
+        today = today or date.today()
+        changed = False
+        seen = set()
+        for path in self._paths():
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            seen.add(path)
+            key = (st.st_mtime_ns, st.st_size)
+            cached = self._files.get(path)
+            if cached is not None and cached[0] == key:
+                continue
+            try:
+                with open(path, encoding='utf-8', errors='replace') as f:
+                    self._files[path] = (key, parse_ics(f))
+            except (OSError, ValueError):
+                logging.exception('reading %s failed', path)
+                continue
+            changed = True
+        for path in set(self._files) - seen:
+            del self._files[path]
+            changed = True
+
+        window = self.window(today)
+        if not changed and window == self._window:
+            return False
+        self._window = window
+        try:
+            self._build(*window)
+        except Exception:
+            # the old index stays, tried again when a file or the day changes
+            logging.exception('expanding events failed')
+            return False
+        self.version += 1
+        return True
+
+    def _build(self, window_start, window_end):
+        events = [event for _, file_events in self._files.values()
+                  for event in file_events]
+        # single instances moved or edited replace their recurrence
+        moved = {}
+        for event in events:
+            if event.recurrence_id is not None:
+                moved.setdefault(event.uid, set()).add(event.recurrence_id)
+
+        found = []
+        for event in events:
+            skip = event.exdates
+            if event.rrule and event.uid in moved:
+                skip = skip | moved[event.uid]
+            for start, end in occurrences(event, window_start, window_end,
+                                          skip):
+                found.append((start, end, event.summary, event.all_day))
+        found.sort()
+        self._index = ([occ[0] for occ in found], found)
+
+    def between(self, start, end):
+        """Occurrences starting in [start, end), in order"""
+        starts, found = self._index
+        return found[bisect.bisect_left(starts, start):
+                     bisect.bisect_left(starts, end)]
+
+    def upcoming(self, now, n):
+        """The next n occurrences starting at or after now"""
+        starts, found = self._index
+        i = bisect.bisect_left(starts, now)
+        return found[i:i + n]
+
+    def busy_days(self, year, month):
+        first = datetime(year, month, 1)
+        return frozenset(start.day for start, _, _, _ in
+                         self.between(first, add_months(first, 1)))
+
+
+def agenda_lines(agenda, now, lines=10):
+    """Today's events, then the next ones, as display lines"""
+    midnight = datetime.combine(now.date(), time())
+    tomorrow = midnight + timedelta(days=1)
+    today = [occ for occ in agenda.between(midnight, tomorrow)
+             if occ[1] > now or occ[3]]
+    text = ['Today']
+    for start, _, summary, all_day in today[:lines - 3]:
+        text.append(summary if all_day else
+                    start.strftime('%H:%M ') + summary)
+    if len(today) == 0:
+        text.append('nothing')
+    text.append('Next')
+    for start, _, summary, _ in agenda.upcoming(tomorrow, lines - len(text)):
+        text.append(start.strftime('%a %d ') + summary)
+    return tuple(text)
+
+
+async def calendar_handler(agenda, cal_state):
+    today = date.today()
+    try:
+        await asyncio.get_running_loop().run_in_executor(
+            None, agenda.refresh, today)
+        cal_state.update(today=today, month=(today.year, today.month),
+                         busy_days=agenda.busy_days(today.year, today.month),
+                         agenda=agenda_lines(agenda, datetime.now()))
+    except Exception:
+        logging.error(traceback.format_exc())
@@ -0,0 +1,200 @@
+"""Render and transfer benchmarks on the fake hardware backends.
+
+Run from the repository root:
+
+    python benchmarks/bench.py --font Minecraftia.ttf --output bench.json
+
+Results are printed and optionally written as JSON so runs from different
+commits can be compared.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from display_driver import mock  # noqa: E402
+mock.install()
+
+from PIL import ImageFont  # noqa: E402
+from display_driver import ST7789  # noqa: E402
+import piclock  # noqa: E402
+from frame_pipeline import FramePipeline  # noqa: E402
+from marquee import Marquee  # noqa: E402
+from state import State  # noqa: E402
+
+LONG_TITLE = 'An Unreasonably Long Song Title That Needs To Scroll (Remastered 2011)'
+
+
+def timed(f, *args, repeat=20):
+    """Median milliseconds of f(*args) and its last result"""
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = f(*args)
+        samples.append((time.perf_counter() - start) * 1000)
+    return statistics.median(samples), result
+
+
+def spi_counters(disp):
+    return {'bytes': disp.SPI.bytes_written, 'transactions': disp.SPI.transactions}
+
+
+def push(disp, frame, partial):
+    disp.partial_update = partial
+    disp.SPI.reset_counters()
+    disp.ShowBuffer(frame)
+    return spi_counters(disp)
+
+
+def bench_init():
+    start = time.perf_counter()
+    disp = ST7789.ST7789()
+    init_ms = (time.perf_counter() - start) * 1000
+    result = {'init_ms': init_ms}
+    result.update(spi_counters(disp))
+    result['gpio_toggles'] = sum(disp.GPIO.toggles.values())
+    return disp, result
+
+
+def compose_all(compositor):
+    compositor.invalidate()
+    compositor.update()
+    return compositor.compose()
+
+
+def bench_screens(disp, repeat):
+    color = 'WHITE'
+    network = piclock.network_screen(
+        disp, State(net_info=('ssid', '203.0.113.7', '192.168.1.1')))
+    screens = {
+        'home': (lambda t: piclock.render_time(
+            disp, t, '01/02/2026', '', '')),
+        'home_spotify': (lambda t: piclock.render_time(
+            disp, t, '01/02/2026', 'Song Title', 'Artist')),
+        'network': (lambda t: compose_all(network)),
+        'text': (lambda t: piclock.render_text(disp, 'fetching data...')),
+    }
+
+    results = {}
+    for name, render in screens.items():
+        render_ms, image = timed(render, '12:34', repeat=repeat)
+        results[name] = {'render_ms': render_ms}
+        for pixel_format in ('rgb565', 'rgb444'):
+            disp.SetPixelFormat(pixel_format)
+            convert_ms, frame = timed(disp.colorize, image, color,
+                                      repeat=repeat)
+            frame = frame.copy()
+            # the next minute, to measure what a partial update sends
+            following = disp.colorize(render('12:35'), color).copy()
+
+            full = push(disp, frame, partial=False)
+            partial = push(disp, following, partial=True)
+            results[name][pixel_format] = {'colorize_ms': convert_ms,
+                                           'full_frame': full,
+                                           'partial_frame': partial}
+    disp.SetPixelFormat('rgb565')
+    return results
+
+
+async def sample_lag(duration, interval=0.01):
+    lags = []
+    loop = asyncio.get_running_loop()
+    end = loop.time() + duration
+    while loop.time() < end:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append((loop.time() - start - interval) * 1000)
+    return lags
+
+
+async def bench_loop(disp, duration):
+    """Event loop lag while main's display, button and marquee tasks run"""
+    pi = mock.FakePi()
+    pipeline = FramePipeline(disp)
+    pipeline.start()
+    disp.partial_update = True
+    disp.SPI.reset_counters()
+
+    awake = asyncio.Event()
+    awake.set()
+    clock_state = State(display='home', bl_dc=100,
+                        color='WHITE', drawn=None,
+                        time='', net_info=('', '', ''))
+    spotify_state = State(is_playing=True, artist='Artist',
+                          song_title=LONG_TITLE, track_id='x',
+                          progress_ms=0, duration_ms=0)
+    button_state = {button: piclock.ButtonState.UNHELD
+                    for button in ('L', 'R', 'start', 'select')}
+    button_to_pin = {'L': 5, 'R': 6, 'start': 26, 'select': 16}
+    marquees = {'song_title': Marquee(170), 'artist': Marquee(200)}
+
+    screens = {'network': piclock.network_screen(disp, clock_state)}
+    tasks = [
+        asyncio.ensure_future(piclock.periodic_task(
+            0.1, piclock.display_handler, pipeline, clock_state,
+            spotify_state, screens, awake=awake)),
+        asyncio.ensure_future(piclock.periodic_task(
+            0.01, piclock.button_handler, pi, None, pipeline, None,
+            button_state, button_to_pin, clock_state, {})),
+        asyncio.ensure_future(piclock.marquee_handler(
+            pipeline, clock_state, spotify_state, marquees, awake)),
+    ]
+    try:
+        lags = sorted(await sample_lag(duration))
+    finally:
+        for task in tasks:
+            task.cancel()
+        pipeline.stop()
+
+    return {'duration_s': duration,
+            'lag_mean_ms': statistics.mean(lags),
+            'lag_p99_ms': lags[int(len(lags) * 0.99) - 1],
+            'lag_max_ms': lags[-1],
+            'frames_rendered': pipeline.frames_rendered,
+            'frames_pushed': pipeline.frames_pushed,
+            'frames_dropped': pipeline.frames_dropped,
+            'spi_bytes_per_s': disp.SPI.bytes_written / duration}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--font', default=piclock.FONT_PATH,
+                        help='TTF used in place of Minecraftia.ttf')
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--duration', type=float, default=5.0,
+                        help='seconds to run the event loop tasks')
+    parser.add_argument('--output', help='write the results as JSON here')
+    args = parser.parse_args()
+
+    for size in piclock.FONT_SIZES:
+        piclock.fonts[(piclock.FONT_PATH, size)] = ImageFont.truetype(
+            args.font, size)
+
+    disp, init = bench_init()
+    results = {'commit': git_commit(), 'init': init,
+               'screens': bench_screens(disp, args.repeat),
+               'event_loop': asyncio.run(bench_loop(disp, args.duration))}
+
+    text = json.dumps(results, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+"""Check the response cache and weather fetch against a local stand-in server.
+
+Run from the repository root:
+
+    python benchmarks/check_http_cache.py
+
+An aiohttp server on 127.0.0.1 plays Open-Meteo, answering with an ETag and
+honouring If-None-Match. The checks cover a miss, a fresh hit, a stale hit
+revalidated by a background 304, a changed body, reloading the cache file,
+serving the last response while the server is down, and raising when it is
+down and nothing is cached. Exits non-zero on the first failed check.
+"""
+import asyncio
+import json
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiohttp import web  # noqa: E402
+
+from http_cache import ResponseCache  # noqa: E402
+from http_client import HttpClient  # noqa: E402
+from state import State  # noqa: E402
+from weather import weather_url, apply_weather  # noqa: E402
+
+
+class StandIn:
+    """Open-Meteo look-alike counting the 200 and 304 responses it sends"""
+
+    def __init__(self):
+        self.temperature = 21.4
+        self.sent = {200: 0, 304: 0}
+        self.runner = None
+        self.base = None
+
+    def body(self):
+        return json.dumps({
+            'current_weather': {'temperature': self.temperature,
+                                'weathercode': 2},
+            'daily': {'temperature_2m_max': [24.0],
+                      'temperature_2m_min': [12.5]}}).encode()
+
+    async def forecast(self, request):
+        etag = '"%s"' % self.temperature
+        if request.headers.get('If-None-Match') == etag:
+            self.sent[304] += 1
+            return web.Response(status=304, headers={'ETag': etag})
+        self.sent[200] += 1
+        return web.Response(body=self.body(), content_type='application/json',
+                            headers={'ETag': etag})
+
+    async def start(self, port=0):
+        app = web.Application()
+        app.router.add_get('/v1/forecast', self.forecast)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', port)
+        await site.start()
+        port = self.runner.addresses[0][1]
+        self.base = 'http://127.0.0.1:%d/v1/forecast' % port
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+def check(name, ok):
+    print('%-40s %s' % (name, 'ok' if ok else 'FAILED'))
+    if not ok:
+        sys.exit(1)
+
+
+async def settle(cache):
+    """Wait for background revalidations to finish"""
+    while cache._inflight:
+        await asyncio.sleep(0.01)
+
+
+async def main():
+    server = StandIn()
+    await server.start()
+    url = weather_url(52.52, 13.41, base=server.base)
+    http = HttpClient(retries=0, timeout=2)
+    path = os.path.join(tempfile.mkdtemp(), 'http_cache.json')
+    cache = ResponseCache(http, path)
+
+    entry = await cache.get(url, ttl=600)
+    check('miss fetches', server.sent[200] == 1)
+    weather_state = State()
+    apply_weather(weather_state, entry)
+    check('weather parsed', weather_state['temperature'] == '21C'
+          and weather_state['range'] == 'H 24C  L 12C')
+
+    await cache.get(url, ttl=600)
+    check('fresh hit sends nothing', server.sent == {200: 1, 304: 0})
+
+    updates = []
+    stale = await cache.get(url, ttl=0, on_update=lambda: updates.append(1))
+    await settle(cache)
+    check('stale hit returns at once', stale is entry)
+    check('revalidated with a 304', server.sent[304] == 1 and not updates)
+
+    server.temperature = 18.0
+    await cache.get(url, ttl=0, on_update=lambda: updates.append(1))
+    await settle(cache)
+    check('changed body calls on_update', updates == [1]
+          and server.sent[200] == 2)
+
+    reloaded = ResponseCache(http, path)
+    check('reloaded from disk', reloaded.peek(url) is not None
+          and reloaded.peek(url).json()['current_weather']['temperature']
+          == 18.0)
+
+    await server.stop()
+    offline = await reloaded.get(url, ttl=0, max_stale=0)
+    check('offline serves the cached entry', offline is reloaded.peek(url))
+
+    empty = ResponseCache(http, path + '.empty')
+    try:
+        await empty.get(url, ttl=600)
+    except Exception:
+        raised = True
+    else:
+        raised = False
+    check('offline with nothing cached raises', raised)
+
+    await http.close()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,11 +1,41 @@
 #!/usr/bin/python
 
 from display_driver.config import RaspberryPi
+from display_driver.pixel_format import (rgb444_wire, PACKERS, coverage_lut,
+                                         expand)
 import RPi.GPIO as GPIO
 import time
 import numpy as np
 
 
+COLMOD = {'rgb565': 0x05, 'rgb444': 0x03}
+
+# (command, parameters[, seconds to wait after]) sent by Init after the
+# hardware reset
+INIT_SEQUENCE = (
+    (0x36, (0x00,)),  # MADCTL: portrait, RGB order
+    (0x3A, (COLMOD['rgb565'],)),
+    (0x21, ()),  # display inversion on
+    (0x2A, (0x00, 0x00, 0x01, 0x3F)),
+    (0x2B, (0x00, 0x00, 0x00, 0xEF)),
+    (0xB2, (0x0C, 0x0C, 0x00, 0x33, 0x33)),  # porch control
+    (0xB7, (0x35,)),  # gate control
+    (0xBB, (0x1F,)),  # VCOM
+    (0xC0, (0x2C,)),  # LCM control
+    (0xC2, (0x01,)),  # VDV and VRH enable
+    (0xC3, (0x12,)),  # VRH
+    (0xC4, (0x20,)),  # VDV
+    (0xC6, (0x0F,)),  # frame rate, 60 Hz
+    (0xD0, (0xA4, 0xA1)),  # power control
+    (0xE0, (0xD0, 0x08, 0x11, 0x08, 0x0C, 0x15, 0x39,
+            0x33, 0x50, 0x36, 0x13, 0x14, 0x29, 0x2D)),  # positive gamma
+    (0xE1, (0xD0, 0x08, 0x10, 0x08, 0x06, 0x06, 0x39,
+            0x44, 0x51, 0x0B, 0x16, 0x14, 0x2F, 0x31)),  # negative gamma
+    (0x11, (), 0.005),  # sleep out, no command for 5 ms after
+    (0x29, ()),  # display on
+)
+
+
 class ST7789(RaspberryPi):
     def __init__(self):
         super().__init__()
@@ -15,6 +45,20 @@ class ST7789(RaspberryPi):
         self._rst = self.RST_PIN
         self._bl = self.BL_PIN
         self._cs = self.CS_PIN
+        # Preallocated frame and scratch buffers in the current pixel format,
+        # reused by encode, colorize and clear
+        self._frame = np.empty(self.width * self.height, dtype=np.uint16)
+        self._scratch = np.empty(self.width * self.height, dtype=np.uint16)
+        # Last frame pushed to the panel, used to diff when partial_update is on
+        self._shown = np.empty(self.width * self.height, dtype=np.uint16)
+        self._shown_shape = None
+        self._madctl = None
+        self.partial_update = False
+        self.asleep = False
+        self.merge_gap = 16
+        # 'rgb565' sends 2 bytes per pixel, 'rgb444' 3 bytes per 2 pixels
+        self.pixel_format = 'rgb565'
+        self._wire = np.empty(self.width * self.height * 3 // 2, dtype=np.uint8)
         self.Init()
 
     def command(self, cmd):
@@ -29,173 +73,227 @@ class ST7789(RaspberryPi):
         self.spi_writebyte([val])
         self.digital_write(self._cs, GPIO.HIGH)
 
+    def write_register(self, cmd, params=()):
+        """Send a command and all of its parameters under one CS assertion
+
+        DC has to drop for the command byte, so this is one write for the
+        command and one for the parameters instead of one per byte.
+        """
+        self.digital_write(self._cs, GPIO.LOW)
+        self.digital_write(self._dc, GPIO.LOW)
+        self.spi_writebyte([cmd])
+        if params:
+            self.digital_write(self._dc, GPIO.HIGH)
+            self.spi_writebyte(list(params))
+        self.digital_write(self._cs, GPIO.HIGH)
+
     def Init(self):
         """Initialize dispaly"""
         self.module_init()
 
         self.reset()
 
-        self.command(0x36)
-        self.data(0x00)
-
-        self.command(0x3A)
-        self.data(0x05)
-
-        self.command(0x21)
-
-        self.command(0x2A)
-        self.data(0x00)
-        self.data(0x00)
-        self.data(0x01)
-        self.data(0x3F)
-
-        self.command(0x2B)
-        self.data(0x00)
-        self.data(0x00)
-        self.data(0x00)
-        self.data(0xEF)
-
-        self.command(0xB2)
-        self.data(0x0C)
-        self.data(0x0C)
-        self.data(0x00)
-        self.data(0x33)
-        self.data(0x33)
-
-        self.command(0xB7)
-        self.data(0x35)
-
-        self.command(0xBB)
-        self.data(0x1F)
-
-        self.command(0xC0)
-        self.data(0x2C)
-
-        self.command(0xC2)
-        self.data(0x01)
-
-        self.command(0xC3)
-        self.data(0x12)
-
-        self.command(0xC4)
-        self.data(0x20)
-
-        self.command(0xC6)
-        self.data(0x0F)
-
-        self.command(0xD0)
-        self.data(0xA4)
-        self.data(0xA1)
-
-        self.command(0xE0)
-        self.data(0xD0)
-        self.data(0x08)
-        self.data(0x11)
-        self.data(0x08)
-        self.data(0x0C)
-        self.data(0x15)
-        self.data(0x39)
-        self.data(0x33)
-        self.data(0x50)
-        self.data(0x36)
-        self.data(0x13)
-        self.data(0x14)
-        self.data(0x29)
-        self.data(0x2D)
-
-        self.command(0xE1)
-        self.data(0xD0)
-        self.data(0x08)
-        self.data(0x10)
-        self.data(0x08)
-        self.data(0x06)
-        self.data(0x06)
-        self.data(0x39)
-        self.data(0x44)
-        self.data(0x51)
-        self.data(0x0B)
-        self.data(0x16)
-        self.data(0x14)
-        self.data(0x2F)
-        self.data(0x31)
-        self.command(0x21)
-
-        self.command(0x11)
-
-        self.command(0x29)
+        for cmd, params, *wait in INIT_SEQUENCE:
+            self.write_register(cmd, params)
+            if wait:
+                time.sleep(wait[0])
 
     def reset(self):
         """Reset the display"""
         self.digital_write(self._rst, GPIO.HIGH)
-        time.sleep(0.01)
+        time.sleep(0.001)
+        # the pulse needs 10 us. After release the controller is ready in
+        # 5 ms if it was asleep, but 120 ms if it was running, as it is when
+        # piclock restarts
         self.digital_write(self._rst, GPIO.LOW)
-        time.sleep(0.01)
+        time.sleep(0.001)
         self.digital_write(self._rst, GPIO.HIGH)
-        time.sleep(0.01)
+        time.sleep(0.120)
 
-    def SetWindows(self, Xstart, Ystart, Xend, Yend):
-        # set the X coordinates
-        self.command(0x2A)
-        # Set the horizontal starting point to the high octet
-        self.data(Xstart >> 8)
-        # Set the horizontal starting point to the low octet
-        self.data(Xstart & 0xff)
-        self.data(Xend >> 8)  # Set the horizontal end to the high octet
-        self.data((Xend - 1) & 0xff)  # Set the horizontal end to the low octet
-
-        # set the Y coordinates
-        self.command(0x2B)
-        self.data(Ystart >> 8)
-        self.data((Ystart & 0xff))
-        self.data(Yend >> 8)
-        self.data((Yend - 1) & 0xff)
-
-        self.command(0x2C)
+    def Sleep(self):
+        """Display off (0x28) then sleep in (0x10), frame memory is kept"""
+        self.write_register(0x28)
+        self.write_register(0x10)
+        time.sleep(0.005)  # no command for 5 ms after sleep in
+        self.asleep = True
 
-    def ShowImage(self, Image):
-        """Set buffer to value of Python Imaging Library image."""
-        """Write display buffer to physical display"""
-        imwidth, imheight = Image.size
-        if imwidth == self.height and imheight == self.width:
-            img = np.asarray(Image)
-            pix = np.zeros((self.width, self.height, 2), dtype=np.uint8)
-            #RGB888 >> RGB565
-            pix[..., [0]] = np.add(np.bitwise_and(
-                img[..., [0]], 0xF8), np.right_shift(img[..., [1]], 5))
-            pix[..., [1]] = np.add(np.bitwise_and(np.left_shift(
-                img[..., [1]], 3), 0xE0), np.right_shift(img[..., [2]], 3))
-            pix = pix.flatten().tolist()
-
-            self.command(0x36)
-            self.data(0x70)
-            self.SetWindows(0, 0, self.height, self.width)
-            self.digital_write(self._dc, GPIO.HIGH)
-            for i in range(0, len(pix), 4096):
-                self.spi_writebyte(pix[i:i+4096])
+    def Wake(self):
+        """Sleep out (0x11) then display on (0x29)
 
-        else:
-            img = np.asarray(Image)
-            pix = np.zeros((imheight, imwidth, 2), dtype=np.uint8)
+        Sleep in must not follow within 120 ms, the scheduler never does.
+        """
+        self.write_register(0x11)
+        time.sleep(0.005)  # no command for 5 ms after sleep out
+        self.write_register(0x29)
+        self.asleep = False
 
-            pix[..., [0]] = np.add(np.bitwise_and(
-                img[..., [0]], 0xF8), np.right_shift(img[..., [1]], 5))
-            pix[..., [1]] = np.add(np.bitwise_and(np.left_shift(
-                img[..., [1]], 3), 0xE0), np.right_shift(img[..., [2]], 3))
+    def SetWindows(self, Xstart, Ystart, Xend, Yend):
+        # column (0x2A) and row (0x2B) address ranges, ends are inclusive
+        self.write_register(0x2A, (Xstart >> 8, Xstart & 0xff,
+                                   (Xend - 1) >> 8, (Xend - 1) & 0xff))
+        self.write_register(0x2B, (Ystart >> 8, Ystart & 0xff,
+                                   (Yend - 1) >> 8, (Yend - 1) & 0xff))
+        self.write_register(0x2C)
+
+    @property
+    def landscape(self):
+        """Whether the last full frame set MV, exchanging rows and columns"""
+        return bool((self._madctl or 0) & 0x20)
+
+    def SetScrollArea(self, top, height):
+        """Vertical scroll definition (0x33), in frame memory lines
+
+        Lines run along the 320 pixel side, so they are rows in portrait
+        and columns in the landscape (MV) orientation.
+        """
+        bottom = self.height - top - height
+        self.write_register(0x33, (top >> 8, top & 0xff, height >> 8,
+                                   height & 0xff, bottom >> 8, bottom & 0xff))
+
+    def SetScrollStart(self, line):
+        """Vertical scroll start address (0x37)"""
+        self.write_register(0x37, (line >> 8, line & 0xff))
+
+    def ResetScroll(self):
+        self.SetScrollArea(0, self.height)
+        self.SetScrollStart(0)
+
+    def SetPixelFormat(self, pixel_format):
+        """Switch COLMOD (0x3A) between 16 bit RGB565 and 12 bit RGB444
+
+        Frames encoded for the old format must not be pushed afterwards, the
+        next frame is always sent in full.
+        """
+        self.write_register(0x3A, (COLMOD[pixel_format],))
+        self.pixel_format = pixel_format
+        self._shown_shape = None
+
+    def encode(self, Image, out=None):
+        """Pack a PIL RGB image for the current pixel format.
+
+        Returns a (rows, cols) uint16 view, see display_driver.pixel_format.
+        Without out the reusable internal buffer is used, so the view is
+        overwritten by the next call.
+        """
+        if out is None:
+            out = self._frame
+        return PACKERS[self.pixel_format](np.asarray(Image), out, self._scratch)
+
+    def colorize(self, coverage, color, out=None):
+        """Encode an "L" coverage image or array as color text on black.
+
+        Same buffer rules as encode.
+        """
+        if out is None:
+            out = self._frame
+        return expand(np.asarray(coverage),
+                      coverage_lut(color, self.pixel_format), out)
+
+    def write_pixels(self, block):
+        """Send an encoded block as RAMWR data"""
+        if self.pixel_format == 'rgb444':
+            self.spi_writebuffer(rgb444_wire(block, self._wire))
+        else:
+            self.spi_writebuffer(np.ascontiguousarray(block).data.cast('B'))
 
-            pix = pix.flatten().tolist()
+    def ShowImage(self, Image):
+        """Write a PIL image to the physical display"""
+        self.ShowBuffer(self.encode(Image))
+
+    def ShowBuffer(self, pix):
+        """Write an encoded frame, as returned by encode, to the display
+
+        A (width, height) shaped frame is drawn landscape. With partial_update
+        set, only the regions that differ from the last pushed frame are sent.
+        """
+        rotated = pix.shape == (self.width, self.height)
+        madctl = 0x70 if rotated else 0x00
+
+        if (self.partial_update and self._madctl == madctl
+                and self._shown_shape == pix.shape):
+            shown = self._shown[:pix.size].reshape(pix.shape)
+            for box in dirty_boxes(shown, pix, self.merge_gap):
+                self.ShowRegion(pix, box)
+        else:
+            self.write_register(0x36, (madctl,))
+            self._madctl = madctl
+            if rotated:
+                self.SetWindows(0, 0, self.height, self.width)
+                self.digital_write(self._dc, GPIO.HIGH)
+            else:
+                self.SetWindows(0, 0, self.width, self.height)
+                self.digital_write(self._dc, GPIO.HIGH)
+                self.digital_write(self._cs, GPIO.LOW)
+            self.write_pixels(pix)
+
+        self._shown[:pix.size] = pix.ravel()
+        self._shown_shape = pix.shape
+
+    def ShowRegion(self, pix, box):
+        """Write the (x0, y0, x1, y1) region of an encoded frame"""
+        x0, y0, x1, y1 = box
+        if self.pixel_format == 'rgb444' and (x1 - x0) * (y1 - y0) % 2:
+            # a trailing half pair would wrap onto the start of the window
+            if x1 < pix.shape[1]:
+                x1 += 1
+            else:
+                x0 -= 1
+        self.SetWindows(x0, y0, x1, y1)
+        self.digital_write(self._dc, GPIO.HIGH)
+        self.write_pixels(pix[y0:y1, x0:x1])
 
-            self.command(0x36)
-            self.data(0x00)
-            self.SetWindows(0, 0, self.width, self.height)
-            self.digital_write(self._dc, GPIO.HIGH)
-            self.digital_write(self._cs, GPIO.LOW)
-            for i in range(0, len(pix), 4096):
-                self.spi_writebyte(pix[i:i+4096])
+    def ShowBlock(self, block, x0, y0):
+        """Write an encoded block with its top left corner at (x0, y0)
 
-    def clear(self):
-        """Clear contents of image buffer"""
-        _buffer = [0xff]*(self.width * self.height * 2)
+        Coordinates are in the orientation of the last full frame, which is
+        kept up to date so later partial updates still diff correctly. In
+        RGB444 the block must hold an even number of pixels.
+        """
+        rows, cols = block.shape
+        self.SetWindows(x0, y0, x0 + cols, y0 + rows)
+        self.digital_write(self._dc, GPIO.HIGH)
+        self.write_pixels(block)
+        if self._shown_shape is not None:
+            size = self._shown_shape[0] * self._shown_shape[1]
+            shown = self._shown[:size].reshape(self._shown_shape)
+            shown[y0:y0 + rows, x0:x0 + cols] = block
+
+    def clear(self, color='WHITE'):
+        """Fill the whole panel with color, white by default
+
+        Streams from the internal frame buffer, so like encode it overwrites
+        the last frame returned without out.
+        """
+        self._frame.fill(coverage_lut(color, self.pixel_format)[255])
+        self._shown_shape = None
         self.SetWindows(0, 0, self.width, self.height)
         self.digital_write(self._dc, GPIO.HIGH)
-        for i in range(0, len(_buffer), 4096):
-            self.spi_writebyte(_buffer[i:i+4096])
+        self.write_pixels(self._frame)
+
+
+def _runs(idx, gap):
+    """Split sorted indices into (start, end) runs, joining gaps <= gap"""
+    splits = np.flatnonzero(np.diff(idx) > gap) + 1
+    return [(int(run[0]), int(run[-1]) + 1) for run in np.split(idx, splits)]
+
+
+def dirty_boxes(prev, cur, gap=16):
+    """Bounding boxes (x0, y0, x1, y1) of the pixels that differ between frames
+
+    Changed rows are grouped into bands and each band into column runs.
+    Runs closer than gap pixels are merged, since every extra window costs
+    a SetWindows round trip.
+    """
+    changed = prev != cur
+    rows = np.flatnonzero(changed.any(axis=1))
+    if not rows.size:
+        return []
+
+    boxes = []
+    for y0, y1 in _runs(rows, gap):
+        band = changed[y0:y1]
+        for x0, x1 in _runs(np.flatnonzero(band.any(axis=0)), gap):
+            # tighten the rows to this column run
+            sub = np.flatnonzero(band[:, x0:x1].any(axis=1))
+            boxes.append((x0, y0 + int(sub[0]), x1, y0 + int(sub[-1]) + 1))
+    return boxes
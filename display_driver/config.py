@@ -15,6 +15,7 @@ class RaspberryPi:
         self.DC_PIN = 25
         self.BL_PIN = 18
         self.CS_PIN = 18
+        self.spi_bytes = 0
 
         # SPI device, bus = 0, device = 0
 
@@ -28,8 +29,14 @@ class RaspberryPi:
         time.sleep(delaytime / 1000.0)
 
     def spi_writebyte(self, data):
+        self.spi_bytes += len(data)
         self.SPI.writebytes(data)
 
+    def spi_writebuffer(self, data):
+        # writebytes2 takes any buffer-protocol object and chunks it internally
+        self.spi_bytes += memoryview(data).nbytes
+        self.SPI.writebytes2(data)
+
     def module_init(self):
 
         self.GPIO = GPIO
@@ -0,0 +1,215 @@
+"""In-process stand-ins for RPi.GPIO, spidev and pigpio.
+
+install() registers them in sys.modules so the driver and piclock.py can be
+imported and run without a Pi. The fakes count what would have gone over the
+wire: SPI bytes and transactions, GPIO level changes and pigpio calls.
+"""
+import sys
+import types
+from collections import Counter
+
+
+class FakeSpiDev:
+    def __init__(self, bus=0, device=0):
+        self.bus = bus
+        self.device = device
+        self.mode = 0
+        self.max_speed_hz = 0
+        self.closed = False
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.bytes_written = 0
+        self.transactions = 0
+
+    def writebytes(self, data):
+        self.bytes_written += len(data)
+        self.transactions += 1
+
+    def writebytes2(self, data):
+        self.bytes_written += memoryview(data).nbytes
+        self.transactions += 1
+
+    def close(self):
+        self.closed = True
+
+
+def make_gpio():
+    gpio = types.ModuleType('RPi.GPIO')
+    gpio.BCM = 11
+    gpio.OUT = 0
+    gpio.IN = 1
+    gpio.LOW = 0
+    gpio.HIGH = 1
+    gpio.levels = {}
+    gpio.toggles = Counter()
+
+    def output(pin, value):
+        if gpio.levels.get(pin) != value:
+            gpio.toggles[pin] += 1
+        gpio.levels[pin] = value
+
+    def reset_counters():
+        gpio.toggles.clear()
+
+    gpio.setmode = lambda mode: None
+    gpio.setwarnings = lambda flag: None
+    gpio.setup = lambda pin, mode: gpio.levels.setdefault(pin, 0)
+    gpio.output = output
+    gpio.input = lambda pin: gpio.levels.get(pin, 1)
+    gpio.cleanup = lambda: gpio.levels.clear()
+    gpio.reset_counters = reset_counters
+    return gpio
+
+
+class FakeCallback:
+    def __init__(self, pi, pin, edge, func):
+        self.pi = pi
+        self.pin = pin
+        self.edge = edge
+        self.func = func
+
+    def cancel(self):
+        if self in self.pi.callbacks:
+            self.pi.callbacks.remove(self)
+
+
+class FakePi:
+    """pigpio.pi with pull-ups, PWM and edge callbacks kept in memory"""
+
+    def __init__(self, *args, **kwargs):
+        self.connected = True
+        self.levels = {}
+        self.pwm = {}
+        self.waves = {}
+        self.chain = None
+        self.callbacks = []
+        self._wave = []
+        self.calls = Counter()
+
+    def _count(self, name):
+        self.calls[name] += 1
+
+    def set_mode(self, pin, mode):
+        self._count('set_mode')
+
+    def set_pull_up_down(self, pin, pud):
+        self._count('set_pull_up_down')
+        self.levels[pin] = 1 if pud == PUD_UP else 0
+
+    def set_PWM_dutycycle(self, pin, dutycycle):
+        self._count('set_PWM_dutycycle')
+        self.pwm[pin] = dutycycle
+
+    def get_PWM_dutycycle(self, pin):
+        return self.pwm.get(pin, 0)
+
+    def wave_add_new(self):
+        self._wave = []
+
+    def wave_add_generic(self, pulses):
+        self._count('wave_add_generic')
+        self._wave.extend(pulses)
+        return len(self._wave)
+
+    def wave_create(self):
+        wave_id = len(self.waves)
+        while wave_id in self.waves:
+            wave_id += 1
+        self.waves[wave_id], self._wave = self._wave, []
+        return wave_id
+
+    def wave_delete(self, wave_id):
+        del self.waves[wave_id]
+
+    def wave_chain(self, data):
+        """Recorded only, the chain finishes at once"""
+        self._count('wave_chain')
+        self.chain = list(data)
+
+    def wave_tx_busy(self):
+        return 0
+
+    def wave_tx_stop(self):
+        self.chain = None
+
+    def set_glitch_filter(self, pin, steady):
+        self._count('set_glitch_filter')
+
+    def read(self, pin):
+        self._count('read')
+        return self.levels.get(pin, 1)
+
+    def write(self, pin, level):
+        self._count('write')
+        self.set_level(pin, level)
+
+    def callback(self, pin, edge=0, func=None):
+        self._count('callback')
+        cb = FakeCallback(self, pin, edge, func)
+        self.callbacks.append(cb)
+        return cb
+
+    def set_level(self, pin, level, tick=0):
+        """Drive a pin from a test, firing matching edge callbacks"""
+        if self.levels.get(pin) == level:
+            return
+        self.levels[pin] = level
+        for cb in list(self.callbacks):
+            if cb.pin == pin and cb.edge in (EITHER_EDGE, level ^ 1):
+                cb.func(pin, level, tick)
+
+    def stop(self):
+        self.connected = False
+
+
+class pulse:
+    def __init__(self, gpio_on, gpio_off, delay):
+        self.gpio_on = gpio_on
+        self.gpio_off = gpio_off
+        self.delay = delay
+
+
+# pigpio constants used by piclock.py
+OUTPUT = 1
+INPUT = 0
+PUD_UP = 2
+RISING_EDGE = 0
+FALLING_EDGE = 1
+EITHER_EDGE = 2
+TIMEOUT = 2
+
+
+def make_pigpio():
+    pigpio = types.ModuleType('pigpio')
+    pigpio.pi = FakePi
+    pigpio.pulse = pulse
+    for name in ('OUTPUT', 'INPUT', 'PUD_UP', 'RISING_EDGE', 'FALLING_EDGE',
+                 'EITHER_EDGE', 'TIMEOUT'):
+        setattr(pigpio, name, globals()[name])
+    return pigpio
+
+
+def install(force=False):
+    """Register the fakes, keeping real modules that import unless force"""
+    def missing(name):
+        if force:
+            return True
+        try:
+            __import__(name)
+        except ImportError:
+            return True
+        return False
+
+    if missing('RPi.GPIO'):
+        gpio = make_gpio()
+        rpi = types.ModuleType('RPi')
+        rpi.GPIO = gpio
+        sys.modules['RPi'] = rpi
+        sys.modules['RPi.GPIO'] = gpio
+    if missing('spidev'):
+        spidev = types.ModuleType('spidev')
+        spidev.SpiDev = FakeSpiDev
+        sys.modules['spidev'] = spidev
+    if missing('pigpio'):
+        sys.modules['pigpio'] = make_pigpio()
@@ -0,0 +1,90 @@
+"""Pixel packers for the ST7789 transfer formats.
+
+Every packer turns an RGB888 array into one uint16 word per pixel, so
+frames in any format can be diffed, sliced and cached the same way. RGB565
+words are stored in wire (big endian) order and sent as they are; RGB444
+words hold 0x0RGB and are paired into three bytes by rgb444_wire.
+
+Screens of single-color text can instead be rendered once as 8 bit coverage
+("L" images) and expanded through a 256 entry lookup table per color, so a
+color change is a table swap rather than a re-render.
+"""
+import sys
+from functools import lru_cache
+
+import numpy as np
+from PIL import ImageColor
+
+
+def pack_rgb565(img, out, scratch):
+    """Pack an RGB888 array into RGB565 words in wire (big endian) order.
+
+    out and scratch are flat uint16 buffers with room for every pixel of img.
+    Returns a (rows, cols) view of out.
+    """
+    rows, cols = img.shape[0], img.shape[1]
+    pix = out[:rows * cols].reshape(rows, cols)
+    tmp = scratch[:rows * cols].reshape(rows, cols)
+
+    # RGB888 >> RGB565
+    np.left_shift(img[..., 0] & 0xF8, 8, out=pix, dtype=np.uint16)
+    np.left_shift(img[..., 1] & 0xFC, 3, out=tmp, dtype=np.uint16)
+    pix |= tmp
+    pix |= img[..., 2] >> 3
+    if sys.byteorder == 'little':
+        pix.byteswap(inplace=True)
+    return pix
+
+
+def pack_rgb444(img, out, scratch):
+    """Pack an RGB888 array into 0x0RGB words, returning a (rows, cols) view"""
+    rows, cols = img.shape[0], img.shape[1]
+    pix = out[:rows * cols].reshape(rows, cols)
+    tmp = scratch[:rows * cols].reshape(rows, cols)
+
+    np.left_shift(img[..., 0] >> 4, 8, out=pix, dtype=np.uint16)
+    np.left_shift(img[..., 1] >> 4, 4, out=tmp, dtype=np.uint16)
+    pix |= tmp
+    pix |= img[..., 2] >> 4
+    return pix
+
+
+def rgb444_wire(words, out):
+    """Pair 0x0RGB words into RGB444 wire bytes (R1G1 B1R2 G2B2) in out
+
+    words must hold an even number of pixels. Returns a view of out.
+    """
+    flat = words.reshape(-1)
+    first, second = flat[0::2], flat[1::2]
+    wire = out[:first.size * 3].reshape(-1, 3)
+    wire[:, 0] = first >> 4
+    wire[:, 1] = ((first & 0xF) << 4) | (second >> 8)
+    wire[:, 2] = second & 0xFF
+    return wire.reshape(-1)
+
+
+PACKERS = {'rgb565': pack_rgb565, 'rgb444': pack_rgb444}
+
+
+@lru_cache(maxsize=32)
+def coverage_lut(color, pixel_format='rgb565'):
+    """Words for color drawn at each coverage level 0-255 on black"""
+    if isinstance(color, str):
+        color = ImageColor.getrgb(color)
+    rgb = np.array(color[:3], dtype=np.uint16)
+    ramp = (np.arange(256, dtype=np.uint16)[:, None] * rgb + 127) // 255
+    ramp = ramp.astype(np.uint8).reshape(256, 1, 3)
+    lut = PACKERS[pixel_format](ramp, np.empty(256, np.uint16),
+                                np.empty(256, np.uint16)).reshape(256)
+    lut.flags.writeable = False  # shared by every caller
+    return lut
+
+
+def expand(coverage, lut, out):
+    """Map a uint8 coverage array through lut into out.
+
+    Returns a view of out shaped like coverage.
+    """
+    pix = out[:coverage.size].reshape(coverage.shape)
+    np.take(lut, coverage, out=pix)
+    return pix
@@ -0,0 +1,40 @@
+class HardwareScroller:
+    """Scroll part of the panel by moving the ST7789 scroll start address.
+
+    Content already in frame memory is not sent again, each step only writes
+    the lines it reveals and then updates the two byte start address. Lines
+    are frame memory lines: rows in portrait, columns in landscape.
+    """
+
+    def __init__(self, disp, first=0, count=None):
+        self.disp = disp
+        self.first = first
+        self.count = count if count is not None else disp.height
+        self.pos = 0
+
+    def start(self):
+        self.pos = 0
+        self.disp.SetScrollArea(self.first, self.count)
+        self.disp.SetScrollStart(self.first)
+
+    def scroll(self, block):
+        """Scroll by the lines in block and draw them where they appear
+
+        block is in wire format, shaped (n, width) in portrait and
+        (height, n) in landscape.
+        """
+        # in landscape memory lines are screen columns
+        landscape = self.disp.landscape
+        n = block.shape[1] if landscape else block.shape[0]
+        done = 0
+        while done < n:
+            # the lines scrolled off the top are the ones revealed next
+            step = min(n - done, self.count - self.pos)
+            line = self.first + self.pos
+            if landscape:
+                self.disp.ShowBlock(block[:, done:done + step], line, 0)
+            else:
+                self.disp.ShowBlock(block[done:done + step], 0, line)
+            self.pos = (self.pos + step) % self.count
+            done += step
+        self.disp.SetScrollStart(self.first + self.pos)
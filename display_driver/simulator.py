@@ -0,0 +1,232 @@
+"""Headless ST7789 that decodes the SPI stream into images on disk.
+
+SimulatedST7789 is the real driver with the GPIO and SPI layer replaced by
+a model of the controller: commands, window addresses, MADCTL, scrolling
+and RAMWR pixel data are interpreted the way the panel would, so partial
+updates, bands and hardware scrolling all show up as they would on the Pi.
+"""
+import json
+import os
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from display_driver import mock
+
+mock.install()
+
+from display_driver.ST7789 import ST7789  # noqa: E402
+
+
+class SimulatedST7789(ST7789):
+    """Drop-in ST7789 that records every update as a frame.
+
+    mode is 'png' for a numbered PNG sequence or 'gif' for one animated file
+    written by close(). With highlight set, the regions written since the
+    previous frame are outlined in red. frames.json in out_dir lists each
+    frame with its timestamp, updated regions and bytes sent.
+    """
+
+    LINES = 320  # frame memory lines, the scroll axis
+    COLUMNS = 240
+
+    def __init__(self, out_dir='frames', mode='png', highlight=False):
+        self.out_dir = out_dir
+        self.mode = mode
+        self.highlight = highlight
+        self.memory = np.zeros((self.LINES, self.COLUMNS), dtype=np.uint16)
+        self.frames = []
+        self._gif_frames = []
+        self._start = time.monotonic()
+        self._level = {}
+        self._cmd = None
+        self._params = []
+        self._pending = b''
+        self._ptr = 0
+        self._window = (0, 0, 0, 0)
+        self._regions = []
+        self._bytes = 0
+        self.madctl = 0
+        self.colmod = 0x05
+        self.scroll_area = (0, self.LINES, 0)
+        self.scroll_start = 0
+        self.sleeping = False
+        self.display_on = True
+        os.makedirs(out_dir, exist_ok=True)
+        super().__init__()
+
+    # Hardware layer
+    def module_init(self):
+        pass
+
+    def module_exit(self):
+        pass
+
+    def reset(self):
+        self.memory[:] = 0
+
+    def digital_write(self, pin, value):
+        self._level[pin] = value
+
+    def spi_writebyte(self, data):
+        self._feed(bytes(data))
+
+    def spi_writebuffer(self, data):
+        self._feed(bytes(data))
+
+    # Recorded entry points
+    def ShowBuffer(self, pix):
+        super().ShowBuffer(pix)
+        self.capture()
+
+    def ShowBlock(self, block, x0, y0):
+        super().ShowBlock(block, x0, y0)
+        self.capture()
+
+    def SetScrollStart(self, line):
+        super().SetScrollStart(line)
+        self.capture()
+
+    def clear(self, color='WHITE'):
+        super().clear(color)
+        self.capture()
+
+    def Sleep(self):
+        super().Sleep()
+        self.capture()
+
+    def Wake(self):
+        super().Wake()
+        self.capture()
+
+    # Controller model
+    def _feed(self, data):
+        self._bytes += len(data)
+        if self._level.get(self.DC_PIN) == 0:  # command
+            for cmd in data:
+                self._cmd = cmd
+                self._params = []
+                if cmd in (0x10, 0x11):  # sleep in, sleep out
+                    self.sleeping = cmd == 0x10
+                elif cmd in (0x28, 0x29):  # display off, on
+                    self.display_on = cmd == 0x29
+                elif cmd == 0x2C:
+                    self._ptr = 0
+                    self._pending = b''
+                    self._regions.append(self._window_box())
+            return
+        if self._cmd == 0x2C:
+            self._write_pixels(data)
+            return
+        self._params.extend(data)
+        self._apply_params()
+
+    def _apply_params(self):
+        p = self._params
+        if self._cmd in (0x2A, 0x2B) and len(p) == 4:
+            start, end = (p[0] << 8) | p[1], (p[2] << 8) | p[3]
+            x0, y0, x1, y1 = self._window
+            if self._cmd == 0x2A:
+                self._window = (start, y0, end, y1)
+            else:
+                self._window = (x0, start, x1, end)
+        elif self._cmd == 0x36 and len(p) == 1:
+            self.madctl = p[0]
+        elif self._cmd == 0x3A and len(p) == 1:
+            self.colmod = p[0]
+        elif self._cmd == 0x33 and len(p) == 6:
+            self.scroll_area = ((p[0] << 8) | p[1], (p[2] << 8) | p[3],
+                                (p[4] << 8) | p[5])
+        elif self._cmd == 0x37 and len(p) == 2:
+            self.scroll_start = (p[0] << 8) | p[1]
+
+    def _logical(self):
+        # landscape (MV) addresses lines with x, portrait with y
+        return self.memory.T if self.madctl & 0x20 else self.memory
+
+    def _window_box(self):
+        x0, y0, x1, y1 = self._window
+        return (x0, y0, x1 + 1, y1 + 1)
+
+    def _decode(self, data):
+        if self.colmod != 0x03:
+            usable = len(data) - len(data) % 2
+            return usable, np.frombuffer(data[:usable], dtype='>u2')
+        # RGB444 packs two pixels into three bytes, stored here as 565
+        usable = len(data) - len(data) % 3
+        b = np.frombuffer(data[:usable], dtype=np.uint8).reshape(-1, 3)
+        b = b.astype(np.uint16)
+        nib = np.empty((len(b), 6), dtype=np.uint16)
+        nib[:, 0::2] = b >> 4
+        nib[:, 1::2] = b & 0x0F
+        r, g, bl = nib.reshape(-1, 3).T
+        values = (((r << 1) | (r >> 3)) << 11 | ((g << 2) | (g >> 2)) << 5
+                  | ((bl << 1) | (bl >> 3)))
+        return usable, values
+
+    def _write_pixels(self, data):
+        data = self._pending + data
+        usable, values = self._decode(data)
+        self._pending = data[usable:]
+        if not values.size:
+            return
+        x0, y0, x1, y1 = self._window_box()
+        region = self._logical()[y0:y1, x0:x1]
+        end = min(self._ptr + values.size, region.size)
+        region.flat[self._ptr:end] = values[:end - self._ptr]
+        self._ptr = end
+
+    # Output
+    def visible(self):
+        """Current panel contents as an RGB image, scroll applied"""
+        lines = self.memory
+        top, height, _ = self.scroll_area
+        if height and self.scroll_start != top:
+            order = np.arange(self.LINES)
+            shift = self.scroll_start - top
+            order[top:top + height] = top + (np.arange(height) + shift) % height
+            lines = lines[order]
+        view = lines.T if self.madctl & 0x20 else lines
+        if self.sleeping or not self.display_on:
+            return Image.new('RGB', (view.shape[1], view.shape[0]))
+        rgb = np.empty(view.shape + (3,), dtype=np.uint8)
+        rgb[..., 0] = (view >> 11) << 3
+        rgb[..., 1] = ((view >> 5) & 0x3F) << 2
+        rgb[..., 2] = (view & 0x1F) << 3
+        return Image.fromarray(rgb)
+
+    def capture(self):
+        t = time.monotonic() - self._start
+        image = self.visible()
+        if self.highlight:
+            draw = ImageDraw.Draw(image)
+            for x0, y0, x1, y1 in self._regions:
+                draw.rectangle((x0, y0, x1 - 1, y1 - 1), outline=(255, 0, 0))
+
+        index = len(self.frames)
+        entry = {'index': index, 't': round(t, 4), 'bytes': self._bytes,
+                 'regions': self._regions,
+                 'area': sum((x1 - x0) * (y1 - y0)
+                             for x0, y0, x1, y1 in self._regions)}
+        if self.mode == 'png':
+            entry['file'] = 'frame_%05d_%08dms.png' % (index, t * 1000)
+            image.save(os.path.join(self.out_dir, entry['file']))
+        else:
+            self._gif_frames.append((t, image))
+        self.frames.append(entry)
+        self._regions = []
+        self._bytes = 0
+
+    def close(self):
+        """Write frames.json and, in gif mode, the animation"""
+        if self._gif_frames:
+            times = [t for t, _ in self._gif_frames]
+            durations = [max(20, int((b - a) * 1000))
+                         for a, b in zip(times, times[1:])] + [1000]
+            images = [image for _, image in self._gif_frames]
+            images[0].save(os.path.join(self.out_dir, 'frames.gif'),
+                           save_all=True, append_images=images[1:],
+                           duration=durations, loop=0)
+        with open(os.path.join(self.out_dir, 'frames.json'), 'w') as f:
+            json.dump(self.frames, f, indent=1)
@@ -0,0 +1,226 @@
+import collections
+import logging
+import queue
+import threading
+import traceback
+
+import numpy as np
+
+
+class LatestSlot:
+    """Single-slot mailbox where the newest item replaces any unread one"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._item = None
+        self._full = False
+
+    def put(self, item):
+        """Store item, returning the stale item it replaced (or None)"""
+        with self._cond:
+            stale = self._item if self._full else None
+            self._item = item
+            self._full = True
+            self._cond.notify()
+        return stale
+
+    def get(self, timeout=None):
+        """Wait for an item, returning None on timeout"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._full, timeout):
+                return None
+            item = self._item
+            self._item = None
+            self._full = False
+            return item
+
+    def take(self):
+        """Pop the pending item without waiting"""
+        return self.get(timeout=0)
+
+
+class FramePipeline:
+    """Render and SPI transfer workers fed from the event loop.
+
+    The loop only calls publish() with a render function and a snapshot of
+    the state it needs. A render thread turns the latest request into a
+    wire-format frame in one of two framebuffers while a transfer thread
+    pushes the previous one. Requests and frames that are superseded before
+    they are picked up are dropped, never queued.
+
+    Bands are small blocks, such as a scrolling text line, that are pushed
+    on their own and painted again on top of every full frame until cleared.
+    Commands are driver calls run in order on the transfer thread, ahead of
+    any pending frame.
+    """
+
+    def __init__(self, disp):
+        self.disp = disp
+        self._requests = LatestSlot()
+        self._idle = LatestSlot()
+        self._transfer = threading.Condition()
+        self._frame = None
+        self._bands = {}
+        self._dirty_bands = set()
+        self._commands = collections.deque()
+        self._free = queue.Queue()
+        for _ in range(2):
+            self._free.put(np.empty(disp.width * disp.height, dtype=np.uint16))
+        self._stopping = threading.Event()
+        self._render_thread = None
+        self._transfer_thread = None
+        self.frames_rendered = 0
+        self.frames_pushed = 0
+        self.frames_dropped = 0
+
+    def start(self):
+        self._stopping.clear()
+        self._render_thread = threading.Thread(
+            target=self._render_loop, daemon=True)
+        self._transfer_thread = threading.Thread(
+            target=self._transfer_loop, daemon=True)
+        self._render_thread.start()
+        self._transfer_thread.start()
+
+    def stop(self):
+        self._stopping.set()
+        self._render_thread.join()
+        with self._transfer:
+            self._transfer.notify()
+        self._transfer_thread.join()
+
+    def publish(self, render, *args):
+        """Request a frame from render(*args), replacing any pending request
+
+        render returns a PIL image, encoded with disp.encode, or a
+        (coverage, color) pair that is expanded with disp.colorize.
+        """
+        if self._requests.put((render, args)) is not None:
+            self.frames_dropped += 1
+
+    def publish_band(self, key, block, x0, y0):
+        """Push a wire-format block at (x0, y0), replacing band key"""
+        with self._transfer:
+            self._bands[key] = (block, x0, y0)
+            self._dirty_bands.add(key)
+            self._transfer.notify()
+
+    def clear_band(self, key):
+        with self._transfer:
+            self._bands.pop(key, None)
+            self._dirty_bands.discard(key)
+
+    def clear_bands(self):
+        with self._transfer:
+            self._bands.clear()
+            self._dirty_bands.clear()
+
+    def command(self, f, *args):
+        """Run f(*args) on the transfer thread, which owns the SPI bus"""
+        with self._transfer:
+            self._commands.append((f, args))
+            self._transfer.notify()
+
+    def set_pixel_format(self, pixel_format):
+        """Switch the panel to pixel_format on the transfer thread
+
+        The pending frame and the bands were encoded for the old format, so
+        the switch drops them; publish a fresh frame and bands afterwards.
+        """
+        self.command(self._switch_format, pixel_format)
+
+    def prefetch(self, work, *args):
+        """Run work(*args) on the render thread once no frame is pending"""
+        self._idle.put((work, args))
+
+    def _render_loop(self):
+        while not self._stopping.is_set():
+            request = self._requests.get(timeout=0.5)
+            if request is None:
+                idle = self._idle.take()
+                if idle is not None:
+                    work, args = idle
+                    self._run(work, *args)
+                continue
+
+            render, args = request
+            pixel_format = self.disp.pixel_format
+            frame = self._run(render, *args)
+            if frame is None:
+                continue
+            self.frames_rendered += 1
+
+            buf = self._free.get()
+            if isinstance(frame, tuple):
+                frame = self.disp.colorize(*frame, out=buf)
+            else:
+                frame = self.disp.encode(frame, out=buf)
+            with self._transfer:
+                if self.disp.pixel_format != pixel_format:
+                    # the format was switched while this one was encoded
+                    stale = (frame, buf)
+                else:
+                    stale = self._frame
+                    self._frame = (frame, buf)
+                    self._transfer.notify()
+            if stale is not None:
+                self.frames_dropped += 1
+                self._release(stale[1])
+
+    def _transfer_loop(self):
+        while True:
+            with self._transfer:
+                self._transfer.wait_for(lambda: self._stopping.is_set() or
+                                        self._commands or self._frame or
+                                        self._dirty_bands)
+                if self._stopping.is_set():
+                    return
+                commands = list(self._commands)
+                self._commands.clear()
+
+            # before taking the frame and bands, a command may drop them
+            for f, args in commands:
+                self._run(f, *args)
+            with self._transfer:
+                item = self._frame
+                self._frame = None
+                if item is not None:
+                    # a full frame paints over every band
+                    keys = self._bands.keys()
+                else:
+                    keys = self._dirty_bands
+                bands = [self._bands[key] for key in keys]
+                self._dirty_bands = set()
+
+            try:
+                if item is not None:
+                    self.disp.ShowBuffer(item[0])
+                    self.frames_pushed += 1
+                for block, x0, y0 in bands:
+                    self.disp.ShowBlock(block, x0, y0)
+            except Exception:
+                logging.error(traceback.format_exc())
+            finally:
+                if item is not None:
+                    self._release(item[1])
+
+    def _switch_format(self, pixel_format):
+        with self._transfer:
+            self.disp.SetPixelFormat(pixel_format)
+            stale = self._frame
+            self._frame = None
+            self._bands.clear()
+            self._dirty_bands.clear()
+        if stale is not None:
+            self.frames_dropped += 1
+            self._release(stale[1])
+
+    def _release(self, buf):
+        self._free.put(buf)
+
+    def _run(self, f, *args):
+        try:
+            return f(*args)
+        except Exception:
+            logging.error(traceback.format_exc())
+            return None
@@ -0,0 +1,158 @@
+"""Disk-backed HTTP response cache with stale-while-revalidate.
+
+Entries live in memory and are saved to a JSON file, so the last known
+response is available straight after boot and while offline. get() returns
+a fresh entry as is, returns a stale one immediately while revalidating it
+in the background, and only waits on the network when nothing usable is
+cached. Revalidation sends If-None-Match and If-Modified-Since, so an
+unchanged resource costs a bodiless 304.
+"""
+import asyncio
+import json
+import logging
+import time
+
+from metrics import metrics
+from storage import write_json
+
+metrics.describe('piclock_http_cache_total',
+                 'Cache lookups by result: fresh, stale, miss, not_modified')
+
+
+class CacheEntry:
+    def __init__(self, body, etag=None, last_modified=None, fetched_at=0.0):
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at  # wall clock, survives restarts
+
+    def age(self):
+        return time.time() - self.fetched_at
+
+    def text(self):
+        return self.body.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.body)
+
+    def to_dict(self):
+        # latin-1 round trips arbitrary bytes through a JSON string
+        return {'body': self.body.decode('latin-1'), 'etag': self.etag,
+                'last_modified': self.last_modified,
+                'fetched_at': self.fetched_at}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['body'].encode('latin-1'), d.get('etag'),
+                   d.get('last_modified'), d.get('fetched_at', 0.0))
+
+
+class ResponseCache:
+    """GET responses keyed by URL, shared by every cached fetcher"""
+
+    def __init__(self, http, path='.http_cache.json'):
+        self.http = http
+        self.path = path
+        self.entries = {}
+        self._inflight = {}
+        self._save_lock = asyncio.Lock()
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError):
+            logging.exception('ignoring unreadable cache %s', self.path)
+            return
+        self.entries = {url: CacheEntry.from_dict(d) for url, d in data.items()}
+
+    def peek(self, url):
+        """Cached entry for url however old, or None, without any I/O"""
+        return self.entries.get(url)
+
+    async def get(self, url, ttl, max_stale=None, force=False, on_update=None):
+        """Entry for url, fetched only when the cache cannot answer.
+
+        Entries younger than ttl seconds are returned as they are. Older
+        ones, up to max_stale seconds past ttl (no limit when None), are
+        returned at once and revalidated in the background; on_update() is
+        called if that brings a new body. Otherwise, or with force, the
+        request is awaited, falling back to the cached entry if it fails.
+        Raises only when the request fails and nothing is cached.
+        """
+        entry = self.entries.get(url)
+        if entry is not None and not force:
+            age = entry.age()
+            if age < ttl:
+                metrics.inc('piclock_http_cache_total', result='fresh')
+                return entry
+            if max_stale is None or age < ttl + max_stale:
+                metrics.inc('piclock_http_cache_total', result='stale')
+                task = self._revalidate(url)
+                if on_update is not None:
+                    task.add_done_callback(
+                        lambda t: self._notify(t, entry, on_update))
+                return entry
+
+        metrics.inc('piclock_http_cache_total', result='miss')
+        try:
+            # shielded, other callers may be waiting on the same request
+            return await asyncio.shield(self._revalidate(url))
+        except Exception:
+            if entry is None:
+                raise
+            return entry
+
+    def _revalidate(self, url):
+        """The in-flight request for url, starting one if there is none"""
+        task = self._inflight.get(url)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(url))
+            self._inflight[url] = task
+            task.add_done_callback(lambda t: self._done(url, t))
+        return task
+
+    def _done(self, url, task):
+        self._inflight.pop(url, None)
+        if not task.cancelled() and task.exception() is not None:
+            logging.warning('refreshing %s failed: %r', url, task.exception())
+
+    def _notify(self, task, old, on_update):
+        if (not task.cancelled() and task.exception() is None
+                and task.result().body != old.body):
+            on_update()
+
+    async def _fetch(self, url):
+        entry = self.entries.get(url)
+        headers = {}
+        if entry is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified:
+                headers['If-Modified-Since'] = entry.last_modified
+
+        resp = await self.http.get(url, headers=headers)
+        if resp.status == 304 and entry is not None:
+            metrics.inc('piclock_http_cache_total', result='not_modified')
+            entry.fetched_at = time.time()
+        elif resp.status == 200:
+            entry = CacheEntry(resp.body, resp.headers.get('ETag'),
+                               resp.headers.get('Last-Modified'), time.time())
+            self.entries[url] = entry
+        else:
+            raise RuntimeError('GET %s returned %d' % (url, resp.status))
+        await self.save()
+        return entry
+
+    async def save(self):
+        # one writer at a time, they share the temporary file
+        async with self._save_lock:
+            data = {url: entry.to_dict() for url, entry in self.entries.items()}
+            try:
+                await asyncio.get_running_loop().run_in_executor(
+                    None, write_json, self.path, data)
+            except OSError:
+                logging.exception('saving %s failed', self.path)
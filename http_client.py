@@ -0,0 +1,127 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from urllib.parse import urlsplit
+
+from metrics import metrics
+
+# aiohttp is by far the slowest import at startup, load_aiohttp() pulls it in
+# on first use so the clock can be drawn before it is needed
+aiohttp = None
+
+
+def load_aiohttp():
+    global aiohttp
+    if aiohttp is None:
+        import aiohttp as module
+        aiohttp = module
+    return aiohttp
+
+
+class HttpResponse:
+    """Fully read response, safe to use after the connection is released"""
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def text(self):
+        return self.body.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.body)
+
+
+class HttpClient:
+    """Long-lived aiohttp session shared by every fetcher.
+
+    Connections are pooled and kept alive, so polling the same host does not
+    pay a TCP and TLS handshake per request. Connection errors, timeouts,
+    429 and 5xx responses are retried with jittered exponential backoff.
+    """
+
+    RETRY_STATUS = (429, 500, 502, 503, 504)
+
+    def __init__(self, limit=8, limit_per_host=2, timeout=10, retries=3,
+                 backoff=0.5, max_backoff=30):
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._session = None
+
+    @property
+    def session(self):
+        # created lazily so it binds to the running loop
+        if self._session is None or self._session.closed:
+            load_aiohttp()
+            connector = aiohttp.TCPConnector(
+                limit=self.limit, limit_per_host=self.limit_per_host,
+                keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self._session
+
+    async def preload(self):
+        """Import aiohttp on a worker thread instead of stalling the loop"""
+        await asyncio.get_running_loop().run_in_executor(None, load_aiohttp)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def backoff_delay(self, attempt):
+        # full jitter keeps retrying clients from synchronising
+        cap = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return random.uniform(0, cap)
+
+    async def request(self, method, url, **kwargs):
+        """Send a request, returning an HttpResponse.
+
+        Raises the last error once the retries are used up. A retryable status
+        on the final attempt is returned rather than raised.
+        """
+        parts = urlsplit(url)
+        endpoint = parts.netloc + parts.path
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            try:
+                # self.session loads aiohttp, which the except clause needs
+                async with self.session.request(method, url, **kwargs) as resp:
+                    body = await resp.read()
+                    response = HttpResponse(resp.status, resp.headers, body)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.inc('piclock_http_requests_total',
+                            endpoint=endpoint, status='error')
+                if attempt >= self.retries:
+                    raise
+                logging.warning('%s %s failed: %r', method, url, e)
+                delay = self.backoff_delay(attempt)
+            else:
+                metrics.observe('piclock_http_request_seconds',
+                                time.perf_counter() - start, endpoint=endpoint)
+                metrics.inc('piclock_http_requests_total',
+                            endpoint=endpoint, status=str(response.status))
+                if (response.status not in self.RETRY_STATUS
+                        or attempt >= self.retries):
+                    return response
+                delay = self.backoff_delay(attempt)
+                retry_after = response.headers.get('Retry-After')
+                if retry_after is not None and retry_after.isdigit():
+                    delay = max(delay, min(int(retry_after), self.max_backoff))
+            attempt += 1
+            await asyncio.sleep(delay)
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
@@ -0,0 +1,109 @@
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from display_driver.pixel_format import coverage_lut
+
+
+class Marquee:
+    """One horizontally scrolling line of text.
+
+    The text is rasterized once into an off-screen coverage strip and
+    expanded to wire format for the current color. Each tick only slices a
+    band-sized viewport out of that strip, so scrolling costs a small block
+    transfer instead of a full-screen render.
+    """
+
+    def __init__(self, y, height=30, width=320, x_pad=2, gap=48, speed=40):
+        self.y = y
+        self.height = height
+        self.width = width
+        self.x_pad = x_pad
+        self.gap = gap
+        self.speed = speed  # pixels per second
+        self.scrolls = False
+        self._key = None
+        self._style = None
+        self._coverage = None
+        self._strip = None
+        self._start = 0
+
+    def set_text(self, text, font, color, pixel_format='rgb565'):
+        """Rasterize text unless it is already the current strip
+
+        A new color or pixel format only re-expands the existing strip.
+        """
+        key = (text, font)
+        if key != self._key:
+            self._key = key
+            self._style = None
+            text_width, _ = font.getsize(text)
+            self.scrolls = self.x_pad + text_width > self.width
+            if not self.scrolls:
+                self._coverage = self._strip = None
+                return
+
+            strip_width = self.x_pad + text_width + self.gap
+            strip = Image.new('L', (strip_width, self.height), 0)
+            ImageDraw.Draw(strip).text((self.x_pad, 0), text, font=font,
+                                       fill=255)
+            self._coverage = np.asarray(strip)
+            self._start = time.monotonic()
+
+        style = (color, pixel_format)
+        if self.scrolls and style != self._style:
+            self._style = style
+            self._strip = coverage_lut(color, pixel_format)[self._coverage]
+
+    def view(self, now=None):
+        """Wire-format block for the current scroll position, None if static"""
+        if not self.scrolls:
+            return None
+        if now is None:
+            now = time.monotonic()
+        strip_width = self._strip.shape[1]
+        offset = int((now - self._start) * self.speed) % strip_width
+        return self._strip.take(range(offset, offset + self.width),
+                                axis=1, mode='wrap')
+
+
+class Ticker:
+    """Full-height text strip fed column by column to a HardwareScroller"""
+
+    def __init__(self, height=240, gap=320, step=4):
+        self.height = height
+        self.gap = gap
+        self.step = step  # columns revealed per tick
+        self._key = None
+        self._style = None
+        self._coverage = None
+        self._strip = None
+        self._offset = 0
+
+    def set_text(self, text, font, color, pixel_format='rgb565'):
+        key = (text, font)
+        if key != self._key:
+            self._key = key
+            self._style = None
+            text_width, text_height = font.getsize(text)
+            # trailing gap so consecutive passes do not run into each other
+            strip_width = text_width + self.gap
+            strip = Image.new('L', (strip_width, self.height), 0)
+            y_pos = (self.height - text_height) // 2
+            ImageDraw.Draw(strip).text((0, y_pos), text, font=font, fill=255)
+            self._coverage = np.asarray(strip)
+            self._offset = 0
+
+        style = (color, pixel_format)
+        if style != self._style:
+            self._style = style
+            self._strip = coverage_lut(color, pixel_format)[self._coverage]
+
+    def next_block(self):
+        """Wire-format columns to reveal next, shaped (height, step)"""
+        strip_width = self._strip.shape[1]
+        block = self._strip.take(range(self._offset, self._offset + self.step),
+                                 axis=1, mode='wrap')
+        self._offset = (self._offset + self.step) % strip_width
+        return block
@@ -0,0 +1,191 @@
+"""Lightweight in-process metrics with a Prometheus text exporter.
+
+Everything is plain counters and fixed-bucket histograms behind one lock,
+cheap enough to leave on. The registry is rendered in the Prometheus text
+format to a file (for node_exporter's textfile collector) and/or served on
+a Unix socket.
+"""
+import asyncio
+import bisect
+import gc
+import logging
+import os
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1, 2.5, 5, 10)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._collectors = []
+        self._help = {}
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram()
+            hist.observe(value)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._gauges[key] = value
+
+    def add_collector(self, collect):
+        """collect() returns (name, kind, labels, value) samples at export"""
+        self._collectors.append(collect)
+
+    def render(self):
+        lines = []
+        typed = set()
+
+        def header(name, kind):
+            if name not in typed:
+                typed.add(name)
+                if name in self._help:
+                    lines.append('# HELP %s %s' % (name, self._help[name]))
+                lines.append('# TYPE %s %s' % (name, kind))
+
+        samples = []
+        for collect in self._collectors:
+            try:
+                samples.extend(collect())
+            except Exception:
+                logging.exception('metrics collector failed')
+
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                samples.append((name, 'counter', labels, value))
+            for (name, labels), value in sorted(self._gauges.items()):
+                samples.append((name, 'gauge', labels, value))
+            histograms = [(key, list(h.counts), h.sum, h.count, h.buckets)
+                          for key, h in sorted(self._histograms.items())]
+
+        for name, kind, labels, value in samples:
+            header(name, kind)
+            lines.append('%s%s %s' % (name, format_labels(labels), value))
+
+        for (name, labels), counts, total, count, buckets in histograms:
+            header(name, 'histogram')
+            cumulative = 0
+            for bound, n in zip(buckets + ('+Inf',), counts):
+                cumulative += n
+                lines.append('%s_bucket%s %d' % (
+                    name, format_labels(labels + (('le', bound),)), cumulative))
+            lines.append('%s_sum%s %f' % (name, format_labels(labels), total))
+            lines.append('%s_count%s %d' % (name, format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path):
+        # write and rename so a scraper never reads half a file
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(self.render())
+        os.replace(tmp, path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('"', '\\"'))
+                             for k, v in labels)
+
+
+metrics = Metrics()
+metrics.describe('piclock_task_seconds', 'Duration of periodic task callbacks')
+metrics.describe('piclock_loop_lag_seconds', 'Event loop scheduling delay')
+metrics.describe('piclock_gc_seconds', 'Garbage collector pause')
+metrics.describe('piclock_http_request_seconds', 'HTTP latency per endpoint')
+metrics.describe('piclock_time_to_first_frame_seconds',
+                 'Process start until the first frame was on the panel')
+
+
+def process_uptime():
+    """Seconds since this process was started, interpreter startup included"""
+    with open('/proc/self/stat') as f:
+        # comm may contain spaces, starttime is the 20th field after it
+        start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+    return (time.clock_gettime(time.CLOCK_BOOTTIME)
+            - start_ticks / os.sysconf('SC_CLK_TCK'))
+
+
+async def sample_loop_lag(interval=0.25, awake=None):
+    """Record how late the loop wakes a sleeping task.
+
+    With awake given, sampling pauses while the event is clear.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        if awake is not None:
+            await awake.wait()
+        start = loop.time()
+        await asyncio.sleep(interval)
+        metrics.observe('piclock_loop_lag_seconds',
+                        max(0.0, loop.time() - start - interval))
+
+
+def track_gc():
+    starts = {}
+
+    def on_gc(phase, info):
+        if phase == 'start':
+            starts[info['generation']] = time.perf_counter()
+        elif info['generation'] in starts:
+            metrics.observe('piclock_gc_seconds',
+                            time.perf_counter() - starts.pop(info['generation']),
+                            generation=info['generation'])
+
+    gc.callbacks.append(on_gc)
+
+
+async def export_textfile(path, interval=15, awake=None):
+    while True:
+        if awake is not None:
+            await awake.wait()
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, metrics.write, path)
+        except OSError:
+            logging.exception('writing metrics to %s failed', path)
+        await asyncio.sleep(interval)
+
+
+async def serve_unix(path):
+    """Serve the current metrics to anything that connects to path"""
+    async def handle(reader, writer):
+        writer.write(metrics.render().encode())
+        await writer.drain()
+        writer.close()
+
+    if os.path.exists(path):
+        os.unlink(path)
+    return await asyncio.start_unix_server(handle, path)
@@ -0,0 +1,138 @@
+import array
+import asyncio
+import fcntl
+import logging
+import socket
+import struct
+import traceback
+
+IPIFY_URL = 'https://api.ipify.org'
+
+# linux/wireless.h
+SIOCGIWESSID = 0x8B1B
+IW_ESSID_MAX_SIZE = 32
+
+# linux/rtnetlink.h multicast groups
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+
+
+def read_gateway(path='/proc/net/route'):
+    """Default IPv4 gateway from the kernel routing table, '' if none"""
+    with open(path) as f:
+        next(f)  # header
+        for line in f:
+            fields = line.split()
+            if fields[1] == '00000000' and int(fields[3], 16) & 0x2:  # RTF_GATEWAY
+                return socket.inet_ntoa(struct.pack('<L', int(fields[2], 16)))
+    return ''
+
+
+def read_ssid(ifname):
+    """ESSID of a wireless interface via the SIOCGIWESSID ioctl, '' if none"""
+    essid = array.array('B', bytes(IW_ESSID_MAX_SIZE + 1))
+    addr, length = essid.buffer_info()
+    # struct iwreq: ifname[16] then struct iw_point {pointer, length, flags}
+    req = struct.pack('16sPHH', ifname.encode(), addr, length, 0)
+    try:
+        with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+            res = fcntl.ioctl(s.fileno(), SIOCGIWESSID, req)
+    except OSError:
+        return ''
+    size = struct.unpack('16sPHH', res[:struct.calcsize('16sPHH')])[2]
+    return essid.tobytes()[:size].rstrip(b'\0').decode('utf-8', 'replace')
+
+
+async def run_command(*argv, timeout=10):
+    """Run argv without a shell, killing it if it outlives timeout.
+
+    Returns the exit status, or None if the command timed out.
+    """
+    proc = await asyncio.create_subprocess_exec(
+        *argv, stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE)
+    try:
+        _, stderr = await asyncio.wait_for(proc.communicate(), timeout)
+    except asyncio.TimeoutError:
+        logging.error('timed out: %s', ' '.join(argv))
+        proc.kill()
+        await proc.wait()
+        return None
+    if proc.returncode:
+        logging.error('%s exited %d: %s', ' '.join(argv),
+                      proc.returncode, stderr.decode(errors='replace'))
+    return proc.returncode
+
+
+class NetInfo:
+    """(ssid, public ip, gateway) for one interface.
+
+    The local fields come straight from /proc and an ioctl. The public IP
+    goes through the response cache: the last known address is shown at once
+    and refreshed in the background once ip_ttl has passed, and a link,
+    address or route change reported by the kernel forces a new lookup.
+    """
+
+    def __init__(self, cache, ifname='wlan0', ip_ttl=3600):
+        self.cache = cache
+        self.ifname = ifname
+        self.ip_ttl = ip_ttl
+        self._stale = False
+        self._sock = None
+        self._pending = None
+        self._on_change = None
+
+    async def fetch(self):
+        force, self._stale = self._stale, False
+        public_ip = await self.fetch_public_ip(force)
+        return (read_ssid(self.ifname), public_ip or '', read_gateway())
+
+    async def fetch_public_ip(self, force=False):
+        try:
+            entry = await self.cache.get(IPIFY_URL, self.ip_ttl, force=force,
+                                         on_update=self._changed)
+            return entry.text()
+        except Exception:
+            logging.error(traceback.format_exc())
+            return None
+
+    def _changed(self):
+        if self._on_change is not None:
+            self._on_change()
+
+    def invalidate(self):
+        self._stale = True
+
+    def watch(self, loop, on_change, settle=1.0):
+        """Call on_change() once interface events have settled for settle s
+
+        on_change() is also called when a background lookup finds a new
+        public IP.
+        """
+        self._on_change = on_change
+        self._sock = socket.socket(
+            socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self._sock.bind(
+            (0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR | RTMGRP_IPV4_ROUTE))
+        self._sock.setblocking(False)
+
+        def on_readable():
+            try:
+                while self._sock.recv(65536):
+                    pass
+            except BlockingIOError:
+                pass
+            self.invalidate()
+            # events arrive in bursts, only report the last one
+            if self._pending is not None:
+                self._pending.cancel()
+            self._pending = loop.call_later(settle, on_change)
+
+        loop.add_reader(self._sock.fileno(), on_readable)
+
+    def close(self, loop):
+        if self._sock is not None:
+            loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            self._sock = None
@@ -2,26 +2,37 @@ import asyncio
 import pigpio
 import time
 import sys
-import os
 import json
 from itertools import cycle
-import aiohttp
+from functools import lru_cache
 import logging
-from aiohttp import ClientSession
+import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 from display_driver import ST7789
+from frame_pipeline import FramePipeline
+from http_client import HttpClient
+from http_cache import ResponseCache
+from spotify_token import SpotifyToken
+from state import State
+from text_metrics import text_dims
+from widgets import (Compositor, TextWidget, SparklineWidget, MonthWidget,
+                     DayMarker)
+from weather import weather_url, weather_handler, apply_weather
+from sysmon import SystemMonitor, sysmon_handler
+from agenda import Agenda, calendar_handler
+from power import Backlight, PowerScheduler
+from netinfo import NetInfo, run_command
+from marquee import Marquee, Ticker
+from display_driver.scroll import HardwareScroller
+from metrics import (metrics, sample_loop_lag, track_gc, export_textfile,
+                     serve_unix, process_uptime)
+from collections import deque
 from enum import IntEnum
 from ssl import SSLCertVerificationError
 import traceback
 
 # TODO
-# retry+backoff for get post
-# only update display with changes in api_state
 # reboot
-# calendar
-# cpu monitor
-# weather
-# scrolling spotify text
 # launching on startup
 
 
@@ -32,265 +43,581 @@ class ButtonState(IntEnum):
     RELEASED = 3
 
 
-def display_time(disp, spotify_state, color):
-    current_time = time.strftime('%H:%M')
-    current_date = time.strftime('%m/%d/%Y')
+# 'edge' uses pigpio edge callbacks, 'poll' reads the pins every 10 ms
+BUTTON_MODE = 'edge'
 
-    time_date_screen = Image.new('RGB', (disp.height, disp.width), (0, 0, 0))
-    draw = ImageDraw.Draw(time_date_screen)
+# 'rgb444' sends 25% less per frame than 'rgb565', plenty for solid text colors
+PIXEL_FORMAT = 'rgb444'
 
-    # Time
-    font = ImageFont.truetype('Minecraftia.ttf', 48)
-    _, str_width = string_dims(draw, font, current_time)
-    x_pos = (disp.height/2)-str_width/2
-    y_pos = 10
-    draw.text((x_pos, y_pos), current_time, font=font, fill=color)
+# Prometheus text exports, set either to None to disable
+METRICS_PATH = 'piclock.prom'
+METRICS_SOCKET = None
 
-    # Date
-    font = ImageFont.truetype('Minecraftia.ttf', 16)
-    _, str_width = string_dims(draw, font, current_date)
-    x_pos = (disp.height/2)-str_width/2
-    y_pos = (disp.width)/16 + 60
-    draw.text((x_pos, y_pos), current_date, font=font, fill=color)
+# (latitude, longitude) for the weather screen, None leaves the screen out
+WEATHER_LOCATION = None
+WEATHER_UNIT = 'celsius'  # or 'fahrenheit'
 
-    if spotify_state['is_playing']:
-        font = ImageFont.truetype('Minecraftia.ttf', 16)
-        x_pos = 2
-        y_pos = 170
-        draw.text((x_pos, y_pos),
-                  spotify_state['song_title'], font=font, fill=color)
+# System monitor sample period in seconds, one sparkline column per sample
+SYSMON_INTERVAL = 2
 
-        y_pos += 30
-        draw.text((x_pos, y_pos),
-                  spotify_state['artist'], font=font, fill=color)
+# Hours [start, end) the panel sleeps and the screen tasks pause, a button
+# press wakes it for NIGHT_WAKE seconds
+NIGHT_HOURS = (0, 8)
+NIGHT_FADE = 2.0  # backlight fade in seconds
+NIGHT_WAKE = 60
 
-    time_date_screen = time_date_screen.rotate(0)
-    disp.ShowImage(time_date_screen)
+# Directory of .ics files for the calendar screen, None leaves it out
+CALENDAR_PATH = None
+CALENDAR_INTERVAL = 60  # seconds between checks for changed files
 
+FONT_PATH = 'Minecraftia.ttf'
+FONT_SIZES = (16, 48)
 
-def display_network(disp, net_info, color):
-    network_screen = Image.new('RGB', (disp.height, disp.width), (0, 0, 0))
-    draw = ImageDraw.Draw(network_screen)
-    draw.rectangle((0, 0, disp.width, disp.height), outline=0, fill=0)
+# Fonts keyed by (path, size), parsed once and shared by every screen
+fonts = {}
 
-    # SSID
-    font = ImageFont.truetype('Minecraftia.ttf', 16)
-    x_pos = 2
-    y_pos = 2
-    draw.text((x_pos, y_pos), net_info[0], font=font, fill=color)
 
-    # IP
-    font = ImageFont.truetype('Minecraftia.ttf', 16)
-    y_pos += 30
-    draw.text((x_pos, y_pos), "IP: "+net_info[1], font=font, fill=color)
+def get_font(size, path=FONT_PATH):
+    key = (path, size)
+    if key not in fonts:
+        fonts[key] = ImageFont.truetype(path, size)
+    return fonts[key]
 
-    # GW
-    y_pos += 30
-    draw.text((x_pos, y_pos), "GW: "+net_info[2], font=font, fill=color)
 
-    network_screen = network_screen.rotate(0)
-    disp.ShowImage(network_screen)
+def preload_fonts(sizes=FONT_SIZES, path=FONT_PATH):
+    for size in sizes:
+        get_font(size, path)
 
 
-def display_text(disp, text, color):
-    custom_screen = Image.new('RGB', (disp.height, disp.width), (0, 0, 0))
-    draw = ImageDraw.Draw(custom_screen)
-    draw.rectangle((0, 0, disp.width, disp.height), outline=0, fill=0)
+# Screens are drawn as "L" coverage and returned with their color, the frame
+# pipeline expands them through a per-color lookup table. A color change is
+# then a table swap, and one cached render serves every color.
 
-    font = ImageFont.truetype('Minecraftia.ttf', 16)
-    x_pos = 2
-    y_pos = 2
-    draw.text((x_pos, y_pos), text, font=font, fill=color)
+def display_time(disp, spotify_state, color):
+    now = time.localtime()
+    coverage = screen_coverage(render_time, disp, *home_key(now, spotify_state))
+    return coverage, color
 
-    custom_screen = custom_screen.rotate(0)
-    disp.ShowImage(custom_screen)
 
+def prefetch_home_frame(disp, spotify_state):
+    # Render the next minute ahead of time so the minute tick is only a push
+    upcoming = time.localtime(time.time() + 60)
+    screen_coverage(render_time, disp, *home_key(upcoming, spotify_state))
 
-def string_dims(draw, fontType, string):
-    string_height = 0
-    string_width = 0
 
-    for c in string:
-        char_width, char_height = draw.textsize(c, font=fontType)
-        string_height += char_height
-        string_width += char_width
+def home_key(t, spotify_state):
+    if spotify_state['is_playing']:
+        song_title, artist = spotify_state['song_title'], spotify_state['artist']
+    else:
+        song_title, artist = '', ''
+    return (time.strftime('%H:%M', t), time.strftime('%m/%d/%Y', t),
+            song_title, artist)
 
-    return string_height, string_width
 
+@lru_cache(maxsize=8)
+def screen_coverage(render, disp, *args):
+    # Rendered screens keyed by everything drawn on them, shared by all colors
+    return np.asarray(render(disp, *args))
 
-async def api_handler(clock_state, api_info, spotify_state):
-    if clock_state['display'] == 'home':
-        await fetch_spotify(api_info, spotify_state)
 
+def display_text(disp, text, color):
+    return screen_coverage(render_text, disp, text), color
 
-async def fetch_spotify(api_info, spotify_state):
-    url = 'https://api.spotify.com/v1/me/player/currently-playing'
-    headers = {'Authorization': 'Bearer ' + api_info['spotify_access_token'],
-               'Accept': 'application/json', 'Content-Type': 'application/json'}
 
-    resp = None
-    while resp is None:
-        try:
-            async with aiohttp.ClientSession() as session:
-                resp = await session.request(method='GET', url=url, headers=headers)
-        except SSLCertVerificationError:
-            print('SSLCertVerificationError:'+url)
-            await asyncio.sleep(1)
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            await asyncio.sleep(1)
+def render_time(disp, current_time, current_date, song_title, artist):
+    time_date_screen = Image.new('L', (disp.height, disp.width), 0)
+    draw = ImageDraw.Draw(time_date_screen)
 
-    if resp.status == 204:  # valid access code, not active
-        spotify_state['is_playing'] = False
-        spotify_state['artist'] = ''
-        spotify_state['song_title'] = ''
-    elif resp.status == 200:  # valid access code, active
-        data = await resp.json()
-        spotify_state['is_playing'] = data['is_playing']
-        spotify_state['artist'] = data['item']['artists'][0]['name']
-        spotify_state['song_title'] = data['item']['name']
-    else:  # invalid access code or other error
-        print('Spotify request failed error:' + str(resp.status))
-        api_info = await refresh_spotify_access_token(api_info)
-        spotify_state['is_playing'] = False
-        spotify_state['artist'] = ''
-        spotify_state['song_title'] = ''
-
-
-async def refresh_spotify_access_token(api_info):
-    url = 'https://accounts.spotify.com/api/token'
-    headers = {'Authorization': 'Basic ' +
-               api_info['spotify_id_secret_encoded']}
-    data = {'grant_type': 'refresh_token',
-            'refresh_token': api_info['spotify_refresh_token']}
-
-    p = None
-    while p is None:
-        try:
-            async with aiohttp.ClientSession() as session:
-                p = await session.request(method='POST', url=url, data=data, headers=headers)
-        except SSLCertVerificationError:
-            print('SSLCertVerificationError:'+url)
-            await asyncio.sleep(1)
-        except Exception as e:
-            logging.error(traceback.format_exc())
-            await asyncio.sleep(1)
+    # Time
+    font = get_font(48)
+    _, str_width = text_dims(font, current_time)
+    x_pos = (disp.height/2)-str_width/2
+    y_pos = 10
+    draw.text((x_pos, y_pos), current_time, font=font, fill=255)
+
+    # Date
+    font = get_font(16)
+    _, str_width = text_dims(font, current_date)
+    x_pos = (disp.height/2)-str_width/2
+    y_pos = (disp.width)/16 + 60
+    draw.text((x_pos, y_pos), current_date, font=font, fill=255)
+
+    if song_title or artist:
+        font = get_font(16)
+        x_pos = 2
+        y_pos = 170
+        draw.text((x_pos, y_pos), song_title, font=font, fill=255)
+
+        y_pos += 30
+        draw.text((x_pos, y_pos), artist, font=font, fill=255)
+
+    return time_date_screen.rotate(0)
+
+
+def display_widgets(compositor, color):
+    return compositor.compose(), color
+
+
+def network_screen(disp, clock_state):
+    # SSID, public IP and gateway lines
+    screen = Compositor(disp.height, disp.width)
+    font = get_font(16)
+    for row, label in enumerate(('', 'IP: ', 'GW: ')):
+        def text(values, row=row, label=label):
+            return label + values['net_info'][row]
+        y_pos = 2 + 30 * row
+        screen.add(TextWidget((2, y_pos, disp.height, y_pos + 30),
+                              clock_state, ('net_info',), text, font))
+    return screen
+
+
+def weather_screen(disp, weather_state):
+    # Each line redraws only when its own field changes
+    screen = Compositor(disp.height, disp.width)
+    lines = (('temperature', 10, 60, 48), ('conditions', 90, 120, 16),
+             ('range', 130, 160, 16), ('updated', 200, 230, 16))
+    for key, y0, y1, size in lines:
+        def text(values, key=key):
+            return values[key]
+        screen.add(TextWidget((0, y0, disp.height, y1), weather_state,
+                              (key,), text, get_font(size), align='center'))
+    return screen
+
+
+def sysmon_screen(disp, sys_state, monitor):
+    # CPU, memory and temperature, each a label over a sparkline
+    screen = Compositor(disp.height, disp.width)
+    font = get_font(16)
+    sections = (('cpu', monitor.cpu, 0, 100), ('mem', monitor.mem, 0, 100),
+                ('temp', monitor.temp, 30, 85))
+    for row, (key, history, low, high) in enumerate(sections):
+        def text(values, key=key):
+            return values[key]
+        y_pos = 80 * row
+        screen.add(TextWidget((2, y_pos + 2, disp.height, y_pos + 24),
+                              sys_state, (key,), text, font))
+        box = (2, y_pos + 26, disp.height - 2, y_pos + 76)
+        screen.add(SparklineWidget(box, sys_state, 'samples', history.latest,
+                                   low, high))
+    return screen
+
+
+def calendar_screen(disp, cal_state):
+    # Month grid on the left, today's and the next events on the right
+    screen = Compositor(disp.height, disp.width)
+    font = get_font(16)
+    month = screen.add(MonthWidget((0, 2, 168, 146), cal_state, 'month',
+                                   'busy_days', font))
+    screen.add(DayMarker(month, 'today'))
+
+    def text(values):
+        return '\n'.join(values['agenda'])
+    screen.add(TextWidget((174, 2, disp.height, disp.width), cal_state,
+                          ('agenda',), text, font))
+    return screen
+
+
+def render_text(disp, text):
+    custom_screen = Image.new('L', (disp.height, disp.width), 0)
+    draw = ImageDraw.Draw(custom_screen)
+    draw.rectangle((0, 0, disp.width, disp.height), outline=0, fill=0)
 
-    pjson = await p.json()
-    api_info['spotify_access_token'] = pjson['access_token']
+    font = get_font(16)
+    x_pos = 2
+    y_pos = 2
+    draw.text((x_pos, y_pos), text, font=font, fill=255)
 
-    with open('.api_info.json', 'w') as f:
-        json.dump(api_info, f)
+    return custom_screen.rotate(0)
 
 
-async def fetch_net_info():
-    # Collect network information by parsing command line outputs
-    async with aiohttp.ClientSession() as session:
-        resp = await session.request(method='GET', url='https://api.ipify.org')
-    ipaddress = await resp.text()
+SPOTIFY_PLAYER_URL = 'https://api.spotify.com/v1/me/player/currently-playing'
 
-    # netmask = os.popen("ifconfig wlan0 | grep 'Mask' | awk -F: '{print $4}'").read()
-    gateway = os.popen("route -n | grep '^0.0.0.0' | awk '{print $2}'").read()
-    ssid = os.popen(
-        "iwconfig wlan0 | grep 'ESSID' | awk '{print $4}' | awk -F\\\" '{print $2}'").read()
 
-    return (ssid, ipaddress, gateway)
+# Spotify poll intervals in seconds
+SPOTIFY_POLL_PLAYING = 15  # mid-track, catches skips and pauses
+SPOTIFY_POLL_PAUSED = 5
+SPOTIFY_POLL_IDLE = (5, 120)  # doubling backoff while nothing is active
+SPOTIFY_POLL_ERROR = 5
+SPOTIFY_TRACK_END_SLACK = 0.5
+SPOTIFY_POLL_MIN = 1  # floor, a progress past the duration would spin
 
 
-async def button_handler(pi, disp, button_state, button_to_pin, clock_state, cyclers):
+async def api_handler(http, clock_state, token, spotify_state, awake):
+    # Runs for the life of the app, polling Spotify on its own schedule.
+    # Returning to the home screen triggers an immediate poll.
+    poll_at = 0
+    idle_polls = 0
+    was_home = False
+    while True:
+        await awake.wait()
+        home = clock_state['display'] == 'home'
+        if home and (not was_home or time.monotonic() >= poll_at):
+            status = await fetch_spotify(http, token, spotify_state)
+            idle_polls = idle_polls + 1 if status == 204 else 0
+            poll_at = time.monotonic() + spotify_poll_delay(
+                status, spotify_state, idle_polls)
+        was_home = home
+        if not home:
+            await asyncio.sleep(1)
+        else:
+            await asyncio.sleep(min(1, max(0, poll_at - time.monotonic())))
+
+
+def spotify_poll_delay(status, spotify_state, idle_polls):
+    if status == 204:
+        low, high = SPOTIFY_POLL_IDLE
+        return min(high, low * 2 ** (idle_polls - 1))
+    if status != 200:
+        return SPOTIFY_POLL_ERROR
+    if not spotify_state['is_playing']:
+        return SPOTIFY_POLL_PAUSED
+    # poll again right after the predicted end of the track
+    remaining = (spotify_state['duration_ms'] -
+                 spotify_state['progress_ms']) / 1000
+    return max(SPOTIFY_POLL_MIN,
+               min(SPOTIFY_POLL_PLAYING, remaining + SPOTIFY_TRACK_END_SLACK))
+
+
+async def fetch_spotify(http, token, spotify_state, retry=True):
+    """Update spotify_state from the currently playing endpoint.
+
+    Returns the response status, or None if the request failed. The track
+    fields are only rewritten when the track or the playing flag differ.
+    A 401 refreshes the token and retries once before clearing the track.
+    """
+    try:
+        headers = {'Authorization': 'Bearer ' + await token.token(),
+                   'Accept': 'application/json',
+                   'Content-Type': 'application/json'}
+        resp = await http.get(SPOTIFY_PLAYER_URL, headers=headers)
+    except SSLCertVerificationError:
+        print('SSLCertVerificationError:'+SPOTIFY_PLAYER_URL)
+        return None
+    except Exception:
+        logging.error(traceback.format_exc())
+        return None
+
+    if resp.status == 200:  # valid access code, active
+        data = resp.json()
+        item = data.get('item') or {}
+        track_id = item.get('id')
+        is_playing = data['is_playing'] and bool(item)
+        spotify_state['progress_ms'] = data.get('progress_ms') or 0
+        spotify_state['duration_ms'] = item.get('duration_ms', 0)
+        if (track_id == spotify_state['track_id']
+                and is_playing == spotify_state['is_playing']):
+            return resp.status
+        spotify_state['track_id'] = track_id
+        spotify_state['is_playing'] = is_playing
+        spotify_state['artist'] = item['artists'][0]['name'] if item else ''
+        spotify_state['song_title'] = item.get('name', '')
+        return resp.status
+
+    if resp.status == 401 and retry and await token.refresh():
+        return await fetch_spotify(http, token, spotify_state, retry=False)
+    if resp.status != 204:  # invalid access code or other error
+        print('Spotify request failed error:' + str(resp.status))
+    # 204: valid access code, not active
+    spotify_state['track_id'] = None
+    spotify_state['is_playing'] = False
+    spotify_state['artist'] = ''
+    spotify_state['song_title'] = ''
+    return resp.status
+
+
+async def refresh_net_info(net, clock_state):
+    clock_state['net_info'] = await net.fetch()
+
+
+async def button_handler(pi, power, pipeline, net, button_state, button_to_pin, clock_state, cyclers):
     await check_button_state(pi, button_state, button_to_pin)
 
     for button in button_state.keys():
         if button_state[button] == ButtonState.PRESSED:
-            await button_press_handler(pi, disp, clock_state, cyclers, button)
+            await button_press_handler(power, pipeline, net, clock_state, cyclers, button)
 
 
 async def check_button_state(pi, button_state, button_to_pin):
     for button in button_state.keys():
-        if not pi.read(button_to_pin[button]):
-            if button_state[button] == ButtonState.UNHELD:
-                button_state[button] = ButtonState.PRESSED
-            elif button_state[button] == ButtonState.PRESSED or button_state[button] == ButtonState.HELD:
-                button_state[button] = ButtonState.HELD
-        else:
-            if button_state[button] == ButtonState.PRESSED or button_state[button] == ButtonState.HELD:
-                button_state[button] = ButtonState.RELEASED
-            elif button_state[button] == ButtonState.RELEASED or button_state[button] == ButtonState.UNHELD:
-                button_state[button] = ButtonState.UNHELD
+        pressed = not pi.read(button_to_pin[button])
+        button_state[button] = next_button_state(button_state[button], pressed)
+
 
+def next_button_state(state, pressed):
+    if pressed:
+        if state == ButtonState.PRESSED or state == ButtonState.HELD:
+            return ButtonState.HELD
+        return ButtonState.PRESSED
+    else:
+        if state == ButtonState.PRESSED or state == ButtonState.HELD:
+            return ButtonState.RELEASED
+        return ButtonState.UNHELD
 
-async def button_press_handler(pi, disp, clock_state, cyclers, button):
+
+def start_button_callbacks(pi, loop, button_to_pin, button_events, glitch_us=5000):
+    # pigpio calls back from its own thread, hand edges over to the loop
+    pin_to_button = {pin: button for button, pin in button_to_pin.items()}
+
+    def on_edge(gpio, level, tick):
+        if level == pigpio.TIMEOUT:
+            return
+        loop.call_soon_threadsafe(
+            button_events.put_nowait, (pin_to_button[gpio], level == 0))
+
+    callbacks = []
+    for pin in pin_to_button:
+        # edges must be stable for glitch_us, this debounces the buttons
+        pi.set_glitch_filter(pin, glitch_us)
+        callbacks.append(pi.callback(pin, pigpio.EITHER_EDGE, on_edge))
+    return callbacks
+
+
+async def button_event_handler(power, pipeline, net, button_events, button_state, clock_state, cyclers):
+    # Edge driven counterpart of button_handler, sleeps until a button moves
+    while True:
+        button, pressed = await button_events.get()
+        button_state[button] = next_button_state(button_state[button], pressed)
+        if button_state[button] == ButtonState.PRESSED:
+            await button_press_handler(power, pipeline, net, clock_state, cyclers, button)
+            # no further edge arrives while the button stays down
+            button_state[button] = next_button_state(
+                button_state[button], True)
+
+
+async def button_press_handler(power, pipeline, net, clock_state, cyclers, button):
+    # at night a press keeps the screen on a while, and if it was asleep
+    # only wakes it
+    asleep = not power.awake.is_set()
+    power.nudge()
+    if asleep:
+        return
     if button == 'L':
         bl_dc = next(cyclers['bl_dc'])
         clock_state['bl_dc'] = bl_dc
-        pi.set_PWM_dutycycle(24, bl_dc)
+        power.backlight.set(bl_dc)
     elif button == 'R':
         color = next(cyclers['color'])
         clock_state['color'] = color
-        clock_state['update_display'] = True
     elif button == 'start':
         display = next(cyclers['display'])
         clock_state['display'] = display
-        clock_state['update_display'] = True
     elif button == 'select':
+        display = clock_state['display']
         if display == 'home':
             pass
         elif display == 'network':
-            # Reconnect to network
-            display_text(disp, 'reconnecting...', color)
-            os.popen(
-                'sudo ip link set wlan0 down; sleep 5; sudo ip link set wlan0 up')
-            await asyncio.sleep(0.1)
-            clock_state['net_info'] = await fetch_net_info()
-            await asyncio.sleep(0.1)
-            clock_state['update_display'] = True
+            # in the background, the buttons stay responsive meanwhile
+            global reconnect_task
+            if reconnect_task is None or reconnect_task.done():
+                reconnect_task = asyncio.ensure_future(
+                    reconnect_network(pipeline, net, clock_state))
         elif display == 'custom':
             pass
 
 
-async def display_handler(pi, disp, clock_state, spotify_state):
-    clock_cur = time.strftime('%H:%M')
-    if clock_cur != clock_state['time']:
-        clock_state['update_display'] = True
-        clock_state['time'] = clock_cur
-
-    # auto dimming
-    hour_cur = int(time.strftime('%H'))
-    if 0 <= hour_cur and hour_cur < 8 and not clock_state['auto_dim']:
-        clock_state['auto_dim'] = True
-        clock_state['bl_dc_prev'] = clock_state['bl_dc']
-        clock_state['bl_dc'] = 0
-        pi.set_PWM_dutycycle(24, 0)
-    elif hour_cur > 8 and clock_state['auto_dim']:
-        clock_state['auto_dim'] = False
-        clock_state['bl_dc'] = clock_state['bl_dc_prev']
-        pi.set_PWM_dutycycle(24, clock_state['bl_dc'])
-
-    if spotify_state['is_playing']:
-        clock_state['update_display'] = True
-
-    if clock_state['update_display']:
-        clock_state['update_display'] = False
+reconnect_task = None
+
+
+async def reconnect_network(pipeline, net, clock_state):
+    pipeline.publish(display_text, pipeline.disp,
+                     'reconnecting...', clock_state['color'])
+    await run_command('sudo', 'ip', 'link', 'set', net.ifname, 'down')
+    await asyncio.sleep(5)
+    await run_command('sudo', 'ip', 'link', 'set', net.ifname, 'up')
+    net.invalidate()
+    await refresh_net_info(net, clock_state)
+    # redraw over 'reconnecting...' even if nothing changed
+    clock_state.touch('net_info')
+
+
+# Fields of (clock_state, spotify_state) each screen is drawn from
+SCREEN_DEPS = {
+    'home': (('display', 'time', 'color'),
+             ('is_playing', 'song_title', 'artist')),
+    'network': (('display', 'color'), ()),  # widgets track net_info
+    'weather': (('display', 'color'), ()),
+    'system': (('display', 'color'), ()),
+    'calendar': (('display', 'color'), ()),
+    'custom': (('display', 'color'), ()),
+    'log': (('display',), ()),
+}
+
+
+async def display_handler(pipeline, clock_state, spotify_state, screens):
+    # Not run at night, the PowerScheduler dims and sleeps the panel
+    clock_state['time'] = time.strftime('%H:%M')
+
+    # Redraw only when a field the current screen shows has changed
+    screen = clock_state['display']
+    clock_deps, spotify_deps = SCREEN_DEPS[screen]
+    drawn = (screen, clock_state.version_of(*clock_deps),
+             spotify_state.version_of(*spotify_deps))
+
+    # Rendering and SPI transfer happen on the pipeline threads, the loop
+    # only hands over a snapshot of the state each screen needs
+    disp = pipeline.disp
+    if drawn != clock_state['drawn']:
+        was_log = clock_state['drawn'] and clock_state['drawn'][0] == 'log'
+        if was_log and screen != 'log':
+            # undo the hardware scroll before the next screen is pushed
+            pipeline.command(disp.ResetScroll)
+        clock_state['drawn'] = drawn
         if(clock_state['display'] == 'home'):
-            display_time(disp, spotify_state, clock_state['color'])
-        elif(clock_state['display'] == 'network'):
-            display_network(
-                disp, clock_state['net_info'], clock_state['color'])
+            pipeline.publish(display_time, disp,
+                             spotify_state.snapshot(), clock_state['color'])
+        elif screen in screens:
+            pipeline.clear_bands()
+            screens[screen].update()
+            pipeline.publish(display_widgets, screens[screen],
+                             clock_state['color'])
         elif(clock_state['display'] == 'custom'):
-            display_text(disp, 'fetching data...', clock_state['color'])
-
-
-async def periodic_task(tau, f, *args):
+            pipeline.clear_bands()
+            pipeline.publish(display_text, disp,
+                             'fetching data...', clock_state['color'])
+        elif(clock_state['display'] == 'log'):
+            pipeline.clear_bands()
+            pipeline.publish(display_text, disp, '', clock_state['color'])
+    elif screen in screens:
+        # only widgets whose data or timer came due are redrawn
+        if screens[screen].update():
+            pipeline.publish(display_widgets, screens[screen],
+                             clock_state['color'])
+    elif clock_state['display'] == 'home':
+        pipeline.prefetch(prefetch_home_frame, disp, spotify_state.snapshot())
+
+
+MARQUEE_FPS = 20
+TICKER_FPS = 30
+# the ticker strip is rasterized whole at 48 px, about 25 px per character
+LOG_LINE_MAX = 80
+LOG_TEXT_MAX = 400
+
+
+class ScreenLogHandler(logging.Handler):
+    # Keeps one short line per log message for the 'log' ticker screen
+    def __init__(self, maxlen=10):
+        super().__init__()
+        self.lines = deque(maxlen=maxlen)
+
+    def emit(self, record):
+        lines = record.getMessage().strip().splitlines() or ['']
+        # a logged traceback ends with the exception, the useful part
+        line = lines[-1] if lines[0].startswith('Traceback') else lines[0]
+        self.lines.append(line[:LOG_LINE_MAX])
+
+
+async def ticker_handler(pipeline, clock_state, ticker, scroller, log_lines,
+                         awake):
+    # Scrolls the log screen with the panel's hardware scroll, each tick only
+    # sends the few columns that come into view
+    scrolling = False
+    drawn = None
+    loop = asyncio.get_running_loop()
+    while True:
+        await awake.wait()
+        if clock_state['display'] != 'log':
+            scrolling = False
+            await asyncio.sleep(0.5)
+            continue
+        if not scrolling:
+            pipeline.command(scroller.start)
+            scrolling = True
+        text = ('   '.join(log_lines) or 'no log messages')[:LOG_TEXT_MAX]
+        style = (text, clock_state['color'], pipeline.disp.pixel_format)
+        if style != drawn:
+            # rasterizing the strip takes a while, keep it off the loop
+            await loop.run_in_executor(None, ticker.set_text, text,
+                                       get_font(48), *style[1:])
+            drawn = style
+            if clock_state['display'] != 'log':
+                # left meanwhile, the scroll may already have been reset
+                continue
+        pipeline.command(scroller.scroll, ticker.next_block())
+        await asyncio.sleep(1 / TICKER_FPS)
+
+
+async def marquee_handler(pipeline, clock_state, spotify_state, marquees,
+                          awake):
+    # Scrolls Spotify lines that do not fit, pushing only their bands
+    while True:
+        await awake.wait()
+        active = (clock_state['display'] == 'home'
+                  and spotify_state['is_playing'])
+        scrolling = False
+        for field, marquee in marquees.items():
+            if active:
+                marquee.set_text(spotify_state[field], get_font(16),
+                                 clock_state['color'], pipeline.disp.pixel_format)
+            block = marquee.view() if active else None
+            if block is None:
+                pipeline.clear_band(field)
+            else:
+                pipeline.publish_band(field, block, 0, marquee.y)
+                scrolling = True
+        await asyncio.sleep(1 / MARQUEE_FPS if scrolling else 0.5)
+
+
+async def periodic_task(tau, f, *args, awake=None):
+    # with awake given, f is not called while the event is clear
     while True:
+        if awake is not None:
+            await awake.wait()
+        start = time.perf_counter()
         await f(*args)
+        metrics.observe('piclock_task_seconds', time.perf_counter() - start,
+                        task=f.__name__)
         await asyncio.sleep(tau)
 
 
-def main():
+def display_metrics(disp, pipeline):
+    # Sampled at export time rather than counted on the hot path
+    return [('piclock_spi_bytes_total', 'counter', (), disp.spi_bytes),
+            ('piclock_frames_rendered_total', 'counter', (),
+             pipeline.frames_rendered),
+            ('piclock_frames_pushed_total', 'counter', (),
+             pipeline.frames_pushed),
+            ('piclock_frames_dropped_total', 'counter', (),
+             pipeline.frames_dropped)]
+
+
+def start_metrics(loop, disp, pipeline, awake):
+    # Lag and the textfile pause with the screen tasks at night, the socket
+    # only costs a wakeup when something connects
+    metrics.add_collector(lambda: display_metrics(disp, pipeline))
+    track_gc()
+    loop.create_task(sample_loop_lag(awake=awake))
+    if METRICS_PATH:
+        loop.create_task(export_textfile(METRICS_PATH, awake=awake))
+    if METRICS_SOCKET:
+        loop.run_until_complete(serve_unix(METRICS_SOCKET))
+
+
+async def start_network(http, net, clock_state, fetchers):
+    # Last stage of startup, runs once the clock is already on screen
+    await http.preload()
+    for fetcher in fetchers:
+        asyncio.get_running_loop().create_task(fetcher)
+    await refresh_net_info(net, clock_state)
+
+
+def show_first_frame(disp, clock_state, spotify_state):
+    # Drawn synchronously before any task starts, the display handler's
+    # first redraw is then an empty partial update
+    coverage, color = display_time(disp, spotify_state.snapshot(),
+                                   clock_state['color'])
+    disp.ShowBuffer(disp.colorize(coverage, color))
+    first_frame = process_uptime()
+    metrics.set('piclock_time_to_first_frame_seconds', first_frame)
+    logging.info('first frame after %.2f s', first_frame)
+
+
+def main(disp=None):
+    # Startup is staged: the clock is drawn first, then the local tasks
+    # start, and the network and Spotify load in the background
+
     # Init pins and buttons
     pi = pigpio.pi()
-    pi.set_mode(24, pigpio.OUTPUT)
-    pi.set_PWM_dutycycle(24, 100)
+    backlight = Backlight(pi, 24, 100)
 
     pi.set_pull_up_down(5, pigpio.PUD_UP)  # L
     pi.set_pull_up_down(6, pigpio.PUD_UP)  # R
@@ -301,47 +628,128 @@ def main():
                     'start': ButtonState.UNHELD, 'select': ButtonState.UNHELD}
     button_to_pin = {'L': 5, 'R': 6, 'start': 26, 'select': 16}
 
-    # Initialize display
-    disp = ST7789.ST7789()
-    disp.clear()
-    blank_screen = Image.new('RGB', (disp.height, disp.width), (0, 0, 0))
-    disp.ShowImage(blank_screen)
+    # stderr as well, a root handler would otherwise silence the fallback
+    logging.basicConfig()
+    screen_log = ScreenLogHandler()
+    logging.getLogger().addHandler(screen_log)
+
+    preload_fonts()
 
     # Cycling variables
     bl_cycle = cycle([0, 5, 10, 25, 50, 75, 100])
-    display_cycle = cycle(['home', 'network', 'custom'])
+    displays = ['home', 'network', 'weather', 'system', 'calendar', 'custom',
+                'log']
+    if WEATHER_LOCATION is None:
+        displays.remove('weather')
+    if CALENDAR_PATH is None:
+        displays.remove('calendar')
+    display_cycle = cycle(displays)
     color_cycle = cycle(['WHITE', 'RED', 'GREEN', 'BLUE'])
 
-    clock_state = {'display': next(display_cycle),
-                   'bl_dc': 100, 'bl_dc_prev': 100, 'color': next(color_cycle), 'auto_dim': False}
-    clock_state['update_display'] = True
+    clock_state = State(display=next(display_cycle), bl_dc=100,
+                        color=next(color_cycle), drawn=None,
+                        time=time.strftime('%H:%M'), net_info=('', '', ''))
     cyclers = {'display': display_cycle,
                'bl_dc': bl_cycle, 'color': color_cycle}
+    spotify_state = State(is_playing=False, artist='', song_title='',
+                          track_id=None, progress_ms=0, duration_ms=0)
+
+    # Initialize display and show the clock
+    if disp is None:
+        disp = ST7789.ST7789()
+    disp.SetPixelFormat(PIXEL_FORMAT)
+    disp.partial_update = True
+    show_first_frame(disp, clock_state, spotify_state)
+    pipeline = FramePipeline(disp)
+    pipeline.start()
 
     loop = asyncio.get_event_loop()
+    power = PowerScheduler(pipeline, backlight, clock_state, NIGHT_HOURS,
+                           NIGHT_FADE, NIGHT_WAKE)
+    awake = power.awake
 
-    # Initial fetching
     with open('.api_info.json', 'r') as f:
         api_info = json.load(f)
-    spotify_state = {'is_playing': False, 'artist': '', 'song_title': ''}
-    clock_prev = time.strftime('%H:%M')
-    clock_state['time'] = clock_prev
-    clock_state['net_info'] = loop.run_until_complete(fetch_net_info())
+    http = HttpClient()
+    cache = ResponseCache(http)
+    net = NetInfo(cache)
+    net.watch(loop, lambda: loop.create_task(
+        refresh_net_info(net, clock_state)))
 
     # Setup and run event loop
+    button_callbacks = []
+    if BUTTON_MODE == 'edge':
+        button_events = asyncio.Queue()
+        button_callbacks = start_button_callbacks(
+            pi, loop, button_to_pin, button_events)
+        loop.create_task(button_event_handler(
+            power, pipeline, net, button_events, button_state, clock_state, cyclers))
+    else:
+        loop.create_task(periodic_task(
+            0.01, button_handler, pi, power, pipeline, net, button_state, button_to_pin, clock_state, cyclers))
+    loop.create_task(power.run())
+
+    # Weather is shown from the disk cache until the first refresh lands
+    weather_state = State(temperature='--', conditions='', range='',
+                          updated='')
+    fetchers = [api_handler(http, clock_state, SpotifyToken(http, api_info),
+                            spotify_state, awake)]
+    if WEATHER_LOCATION is not None:
+        url = weather_url(*WEATHER_LOCATION, unit=WEATHER_UNIT)
+        if cache.peek(url) is not None:
+            apply_weather(weather_state, cache.peek(url), WEATHER_UNIT)
+        fetchers.append(weather_handler(cache, url, weather_state,
+                                        WEATHER_UNIT, awake=awake))
+    loop.create_task(start_network(http, net, clock_state, fetchers))
+
+    marquees = {'song_title': Marquee(170), 'artist': Marquee(200)}
+    loop.create_task(marquee_handler(
+        pipeline, clock_state, spotify_state, marquees, awake))
+
+    loop.create_task(ticker_handler(pipeline, clock_state, Ticker(disp.width),
+                                    HardwareScroller(disp), screen_log.lines,
+                                    awake))
+
+    # Screens built from widgets, the rest are drawn by display_handler
+    sys_state = State(cpu='', mem='', temp='', samples=0)
+    monitor = SystemMonitor(disp.height - 4)
     loop.create_task(periodic_task(
-        0.01, button_handler, pi, disp, button_state, button_to_pin, clock_state, cyclers))
-
+        SYSMON_INTERVAL, sysmon_handler, monitor, sys_state, awake=awake))
+
+    screens = {'network': network_screen(disp, clock_state),
+               'weather': weather_screen(disp, weather_state),
+               'system': sysmon_screen(disp, sys_state, monitor)}
+    if CALENDAR_PATH is not None:
+        # files are parsed on a worker thread, only changed ones again
+        cal_state = State(today=None, month=None, busy_days=frozenset(),
+                          agenda=())
+        loop.create_task(periodic_task(
+            CALENDAR_INTERVAL, calendar_handler, Agenda(CALENDAR_PATH),
+            cal_state, awake=awake))
+        screens['calendar'] = calendar_screen(disp, cal_state)
     loop.create_task(periodic_task(
-        1, api_handler, clock_state, api_info, spotify_state))
+        0.1, display_handler, pipeline, clock_state, spotify_state, screens,
+        awake=awake))
 
-    loop.create_task(periodic_task(
-        0.1, display_handler, pi, disp, clock_state, spotify_state))
+    start_metrics(loop, disp, pipeline, awake)
 
     try:
         loop.run_forever()
     except(KeyboardInterrupt, SystemExit):
-        loop.stop()
+        pass
+    finally:
+        # run_forever has returned, so the loop can still run the cleanup,
+        # once no task is left to touch what is being closed
+        tasks = asyncio.all_tasks(loop)
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        for callback in button_callbacks:
+            callback.cancel()
+        pipeline.stop()
+        net.close(loop)
+        monitor.close()
+        loop.run_until_complete(http.close())
 
 
 if __name__ == '__main__':
@@ -0,0 +1,176 @@
+"""Night mode: backlight faded out, panel asleep and screen tasks paused.
+
+Inside the night hours the backlight fades to 0, the ST7789 is put into
+display off and sleep in, and every task that only feeds the screen waits on
+the awake event instead of polling. The scheduler itself sleeps until the
+next boundary, so a night costs a handful of wakeups. A button press wakes
+the clock for a while.
+"""
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+import pigpio
+
+
+class Backlight:
+    """PWM backlight whose fades run on pigpio waveforms.
+
+    A fade is a chain of single PWM periods, one per brightness step, each
+    repeated for its share of the fade. pigpio plays the chain from DMA, so
+    the loop only starts it and checks back when it is due to finish.
+    Duty cycles are in pigpio's default 0-255 range.
+    """
+
+    def __init__(self, pi, pin=24, duty=100, frequency=800, steps=32):
+        self.pi = pi
+        self.pin = pin
+        self.period = 1000000 // frequency  # microseconds
+        self.steps = steps  # 7 chain bytes each, pigpio allows 600
+        self.duty = duty
+        self._waves = []
+        self._fading = None
+        pi.set_mode(pin, pigpio.OUTPUT)
+        pi.set_PWM_dutycycle(pin, duty)
+
+    def set(self, duty):
+        """Jump to duty, cutting any fade short"""
+        self._stop()
+        self.pi.set_PWM_dutycycle(self.pin, duty)
+        self.duty = duty
+
+    async def fade(self, duty, seconds=1.0):
+        """Fade to duty over seconds, returns early if superseded"""
+        self._stop()
+        start = self.duty
+        if seconds <= 0 or start == duty:
+            self.set(duty)
+            return
+
+        mask = 1 << self.pin
+        reps = max(1, round(seconds * 1e6 / self.period / self.steps))
+        waves = {}
+        chain = []
+        for step in range(1, self.steps + 1):
+            level = round(start + (duty - start) * step / self.steps)
+            if level not in waves:
+                high = self.period * level // 255
+                pulses = [pigpio.pulse(mask, 0, high),
+                          pigpio.pulse(0, mask, self.period - high)]
+                self.pi.wave_add_new()
+                self.pi.wave_add_generic([p for p in pulses if p.delay])
+                waves[level] = self.pi.wave_create()
+            # loop start, the wave, loop end repeating it reps times
+            chain += [255, 0, waves[level], 255, 1, reps & 0xff, reps >> 8]
+
+        self._waves = list(waves.values())
+        self._fading = fading = (start, duty, time.monotonic(), seconds)
+        # the wave drives the pin until the fade is over
+        self.pi.set_PWM_dutycycle(self.pin, 0)
+        self.pi.wave_chain(chain)
+
+        await asyncio.sleep(seconds)
+        while self._fading is fading and self.pi.wave_tx_busy():
+            await asyncio.sleep(0.05)
+        if self._fading is fading:
+            self.set(duty)
+
+    def _stop(self):
+        if self._fading is None:
+            return
+        # carry on from wherever the interrupted fade had got to
+        start, duty, started, seconds = self._fading
+        done = min(1.0, (time.monotonic() - started) / seconds)
+        self.duty = round(start + (duty - start) * done)
+        self._fading = None
+        self.pi.wave_tx_stop()
+        for wave in self._waves:
+            self.pi.wave_delete(wave)
+        self._waves = []
+
+
+def in_hours(hour, hours):
+    """Whether hour is in [start, end), a range that may wrap past midnight"""
+    start, end = hours
+    if start <= end:
+        return start <= hour < end
+    return hour >= start or hour < end
+
+
+def seconds_until(hour, now):
+    """Seconds from now until the next hour:00"""
+    at = now.replace(hour=hour, minute=0, second=0, microsecond=0)
+    if at <= now:
+        at += timedelta(days=1)
+    return (at - now).total_seconds()
+
+
+class PowerScheduler:
+    """Puts the clock to sleep for the night hours.
+
+    awake is set while the screen is on; tasks that only feed the screen
+    wait on it. The panel keeps its frame memory while asleep, so waking
+    sends sleep out and display on while the backlight is still off, and a
+    fresh frame is drawn before the fade in.
+    """
+
+    def __init__(self, pipeline, backlight, clock_state, hours=(0, 8),
+                 fade=2.0, wake_for=60, recheck=600):
+        self.pipeline = pipeline
+        self.backlight = backlight
+        self.clock_state = clock_state
+        self.hours = hours
+        self.fade = fade
+        self.wake_for = wake_for
+        self.recheck = recheck  # bound on a sleep, the clock may be set late
+        self.awake = asyncio.Event()
+        self.awake.set()
+        self._woken_until = 0
+        self._changed = asyncio.Event()
+
+    def night(self, now=None):
+        now = now or datetime.now()
+        return (in_hours(now.hour, self.hours)
+                and time.monotonic() >= self._woken_until)
+
+    def nudge(self):
+        """A button was pressed, keep the screen on for a while"""
+        if in_hours(datetime.now().hour, self.hours):
+            self._woken_until = time.monotonic() + self.wake_for
+            self._changed.set()
+
+    async def run(self):
+        while True:
+            # cleared first, so a press during a fade is not lost
+            self._changed.clear()
+            now = datetime.now()
+            night = self.night(now)
+            if night and self.awake.is_set():
+                await self.sleep()
+            elif not night and not self.awake.is_set():
+                await self.wake()
+
+            if in_hours(now.hour, self.hours):
+                delay = seconds_until(self.hours[1], now)
+                if not night:
+                    delay = min(delay, self._woken_until - time.monotonic())
+            else:
+                delay = seconds_until(self.hours[0], now)
+            try:
+                await asyncio.wait_for(self._changed.wait(),
+                                       max(0.1, min(delay, self.recheck)))
+            except asyncio.TimeoutError:
+                pass
+
+    async def sleep(self):
+        self.awake.clear()
+        await self.backlight.fade(0, self.fade)
+        self.pipeline.clear_bands()
+        self.pipeline.command(self.pipeline.disp.Sleep)
+
+    async def wake(self):
+        self.pipeline.command(self.pipeline.disp.Wake)
+        # the panel still shows the frame from when it went to sleep
+        self.clock_state.touch('display')
+        self.awake.set()
+        await self.backlight.fade(self.clock_state['bl_dc'], self.fade)
@@ -0,0 +1,36 @@
+"""Run piclock.py against the headless simulator display.
+
+    python simulate.py --out frames --mode gif --highlight
+
+Hardware modules that are not installed are replaced by the fakes in
+display_driver.mock. Frames and frames.json are written when the clock
+is stopped with Ctrl-C.
+"""
+import argparse
+
+from display_driver import mock
+
+mock.install()
+
+from display_driver.simulator import SimulatedST7789  # noqa: E402
+import piclock  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--out', default='frames',
+                        help='directory for frames and frames.json')
+    parser.add_argument('--mode', choices=('png', 'gif'), default='png')
+    parser.add_argument('--highlight', action='store_true',
+                        help='outline the regions updated in each frame')
+    args = parser.parse_args()
+
+    disp = SimulatedST7789(args.out, args.mode, args.highlight)
+    try:
+        piclock.main(disp)
+    finally:
+        disp.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+import asyncio
+import logging
+import time
+import traceback
+
+from storage import write_json
+
+SPOTIFY_TOKEN_URL = 'https://accounts.spotify.com/api/token'
+
+
+class SpotifyToken:
+    """Spotify access token that is refreshed before it expires.
+
+    api_info is the dict loaded from .api_info.json and is updated in place.
+    The expiry is stored in it as a wall clock time, so a restart knows
+    whether the saved token is still good. Concurrent callers share a single
+    in-flight refresh, and the file is rewritten on a worker thread.
+    """
+
+    def __init__(self, http, api_info, path='.api_info.json', margin=60,
+                 retry_after=30):
+        self.http = http
+        self.api_info = api_info
+        self.path = path
+        self.margin = margin  # seconds before expiry to refresh
+        self.retry_after = retry_after
+        self._refresh = None
+        self._failed_at = None
+
+    @property
+    def expires_at(self):
+        return self.api_info.get('spotify_expires_at', 0)
+
+    def expiring(self):
+        if (self._failed_at is not None
+                and time.monotonic() - self._failed_at < self.retry_after):
+            return False
+        return time.time() >= self.expires_at - self.margin
+
+    async def token(self):
+        """Current access token, refreshed first if it is about to expire"""
+        if self.expiring():
+            await self.refresh()
+        return self.api_info['spotify_access_token']
+
+    async def refresh(self):
+        """Refresh now, or wait for the refresh already in flight
+
+        Returns True if the token was replaced.
+        """
+        if self._refresh is None:
+            self._refresh = asyncio.ensure_future(self._fetch())
+            self._refresh.add_done_callback(self._refresh_done)
+        # a cancelled caller must not cancel the refresh the others wait on
+        return await asyncio.shield(self._refresh)
+
+    def _refresh_done(self, task):
+        self._refresh = None
+
+    async def _fetch(self):
+        headers = {'Authorization': 'Basic ' +
+                   self.api_info['spotify_id_secret_encoded']}
+        data = {'grant_type': 'refresh_token',
+                'refresh_token': self.api_info['spotify_refresh_token']}
+        try:
+            resp = await self.http.post(SPOTIFY_TOKEN_URL, data=data,
+                                        headers=headers)
+            if resp.status != 200:
+                raise RuntimeError('token refresh failed: %d %s'
+                                   % (resp.status, resp.text()))
+            pjson = resp.json()
+        except Exception:
+            logging.error(traceback.format_exc())
+            self._failed_at = time.monotonic()
+            return False
+
+        self._failed_at = None
+        self.api_info['spotify_access_token'] = pjson['access_token']
+        self.api_info['spotify_expires_at'] = (time.time()
+                                               + pjson.get('expires_in', 3600))
+        if 'refresh_token' in pjson:  # Spotify may rotate it
+            self.api_info['spotify_refresh_token'] = pjson['refresh_token']
+
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                None, write_json, self.path, dict(self.api_info))
+        except OSError:
+            logging.exception('saving %s failed', self.path)
+        return True
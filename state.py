@@ -0,0 +1,47 @@
+class State:
+    """Dict-like store that records when each field last changed.
+
+    Every assignment that changes a value bumps a global counter and stamps
+    the field with it, so a consumer can remember version_of(*fields) and
+    later tell whether anything it depends on was modified. Assigning an
+    equal value is a no-op.
+    """
+
+    def __init__(self, **fields):
+        self._values = {}
+        self._versions = {}
+        self.version = 0
+        for key, value in fields.items():
+            self[key] = value
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __setitem__(self, key, value):
+        if key in self._values and self._values[key] == value:
+            return
+        self._values[key] = value
+        self.touch(key)
+
+    def __contains__(self, key):
+        return key in self._values
+
+    def get(self, key, default=None):
+        return self._values.get(key, default)
+
+    def update(self, **fields):
+        for key, value in fields.items():
+            self[key] = value
+
+    def touch(self, key):
+        """Mark key as changed even if its value is the same"""
+        self.version += 1
+        self._versions[key] = self.version
+
+    def version_of(self, *keys):
+        """Latest version among keys, 0 if none of them were ever set"""
+        return max((self._versions.get(key, 0) for key in keys), default=0)
+
+    def snapshot(self):
+        """Plain dict copy, safe to hand to another thread"""
+        return dict(self._values)
@@ -0,0 +1,104 @@
+"""CPU, memory and SoC temperature sampled without spawning processes.
+
+Every source is a file kept open and re-read from offset 0; procfs and
+sysfs regenerate their contents on each read, so a sample costs a few small
+reads. History lives in fixed-size ring buffers.
+"""
+import numpy as np
+
+STAT_PATH = '/proc/stat'
+MEMINFO_PATH = '/proc/meminfo'
+THERMAL_PATH = '/sys/class/thermal/thermal_zone0/temp'
+
+
+class RingBuffer:
+    """Fixed-size float history backed by one preallocated array"""
+
+    def __init__(self, size):
+        self._data = np.zeros(size, dtype=np.float32)
+        self.count = 0  # samples ever appended
+
+    def append(self, value):
+        self._data[self.count % self._data.size] = value
+        self.count += 1
+
+    def latest(self, n):
+        """Copy of up to n of the newest samples, oldest first"""
+        n = min(n, self.count, self._data.size)
+        return self._data[(self.count - n + np.arange(n)) % self._data.size]
+
+
+class ProcFile:
+    """Unbuffered handle re-read from the start on every read()"""
+
+    def __init__(self, path, size=256):
+        self._f = open(path, 'rb', buffering=0)
+        self.size = size  # only the head of the file is ever needed
+
+    def read(self):
+        self._f.seek(0)
+        return self._f.read(self.size)
+
+    def close(self):
+        self._f.close()
+
+
+class SystemMonitor:
+    """Samples CPU busy %, memory used % and SoC temperature into histories"""
+
+    def __init__(self, history=320, stat_path=STAT_PATH,
+                 meminfo_path=MEMINFO_PATH, thermal_path=THERMAL_PATH):
+        self.cpu = RingBuffer(history)
+        self.mem = RingBuffer(history)
+        self.temp = RingBuffer(history)
+        self._stat = ProcFile(stat_path)
+        self._meminfo = ProcFile(meminfo_path)
+        try:
+            self._thermal = ProcFile(thermal_path, 16)
+        except OSError:
+            self._thermal = None  # not on a Pi
+        self._prev = None
+
+    @property
+    def samples(self):
+        return self.cpu.count
+
+    def sample(self):
+        """Append and return (cpu %, memory %, temperature C or None)"""
+        # aggregate line: user nice system idle iowait irq softirq steal ...
+        times = [int(field) for field in
+                 self._stat.read().split(b'\n', 1)[0].split()[1:9]]
+        idle, total = times[3] + times[4], sum(times)
+        cpu = 0.0
+        if self._prev is not None:
+            d_total = total - self._prev[1]
+            if d_total:
+                cpu = 100.0 * (1 - (idle - self._prev[0]) / d_total)
+        self._prev = (idle, total)
+
+        meminfo = {}
+        for line in self._meminfo.read().split(b'\n')[:3]:
+            key, value = line.split(b':')
+            meminfo[key] = int(value.split()[0])
+        mem = 100.0 * (1 - meminfo[b'MemAvailable'] / meminfo[b'MemTotal'])
+
+        temp = None
+        if self._thermal is not None:
+            temp = int(self._thermal.read()) / 1000
+
+        self.cpu.append(cpu)
+        self.mem.append(mem)
+        self.temp.append(temp or 0.0)
+        return cpu, mem, temp
+
+    def close(self):
+        for f in (self._stat, self._meminfo, self._thermal):
+            if f is not None:
+                f.close()
+
+
+async def sysmon_handler(monitor, sys_state):
+    cpu, mem, temp = monitor.sample()
+    sys_state.update(cpu='CPU %d%%' % cpu, mem='MEM %d%%' % mem,
+                     temp='TEMP n/a' if temp is None else 'TEMP %.1fC' % temp,
+                     samples=monitor.samples)
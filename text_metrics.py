@@ -0,0 +1,25 @@
+from functools import lru_cache
+
+from PIL import Image, ImageDraw
+
+
+def string_dims(draw, fontType, string):
+    string_height = 0
+    string_width = 0
+
+    for c in string:
+        char_width, char_height = draw.textsize(c, font=fontType)
+        string_height += char_height
+        string_width += char_width
+
+    return string_height, string_width
+
+
+_measure_draw = ImageDraw.Draw(Image.new('RGB', (1, 1)))
+
+
+@lru_cache(maxsize=256)
+def text_dims(fontType, string):
+    # Cached string_dims, fonts come from the shared registry so hash by identity
+    # Hit/miss counters are available from text_dims.cache_info()
+    return string_dims(_measure_draw, fontType, string)
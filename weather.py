@@ -0,0 +1,70 @@
+"""Current conditions from Open-Meteo, served through the response cache."""
+import asyncio
+import logging
+import time
+import traceback
+from urllib.parse import urlencode
+
+WEATHER_URL = 'https://api.open-meteo.com/v1/forecast'
+
+# WMO weather interpretation codes used by Open-Meteo
+WEATHER_CODES = {
+    0: 'Clear', 1: 'Mostly clear', 2: 'Partly cloudy', 3: 'Overcast',
+    45: 'Fog', 48: 'Freezing fog',
+    51: 'Light drizzle', 53: 'Drizzle', 55: 'Heavy drizzle',
+    56: 'Freezing drizzle', 57: 'Freezing drizzle',
+    61: 'Light rain', 63: 'Rain', 65: 'Heavy rain',
+    66: 'Freezing rain', 67: 'Freezing rain',
+    71: 'Light snow', 73: 'Snow', 75: 'Heavy snow', 77: 'Snow grains',
+    80: 'Showers', 81: 'Showers', 82: 'Heavy showers',
+    85: 'Snow showers', 86: 'Snow showers',
+    95: 'Thunderstorm', 96: 'Thunderstorm', 99: 'Thunderstorm',
+}
+
+
+def weather_url(latitude, longitude, unit='celsius', base=WEATHER_URL):
+    return base + '?' + urlencode({
+        'latitude': latitude, 'longitude': longitude,
+        'current_weather': 'true', 'temperature_unit': unit,
+        'daily': 'temperature_2m_max,temperature_2m_min',
+        'timezone': 'auto', 'forecast_days': 1})
+
+
+def parse_weather(data, unit='celsius'):
+    """Display strings for weather_state from an Open-Meteo response"""
+    suffix = 'F' if unit == 'fahrenheit' else 'C'
+    current = data['current_weather']
+    daily = data.get('daily') or {}
+    highs = daily.get('temperature_2m_max') or [None]
+    lows = daily.get('temperature_2m_min') or [None]
+    fields = {'temperature': '%d%s' % (round(current['temperature']), suffix),
+              'conditions': WEATHER_CODES.get(current['weathercode'], ''),
+              'range': ''}
+    if highs[0] is not None and lows[0] is not None:
+        fields['range'] = 'H %d%s  L %d%s' % (round(highs[0]), suffix,
+                                              round(lows[0]), suffix)
+    return fields
+
+
+def apply_weather(weather_state, entry, unit='celsius'):
+    weather_state.update(
+        updated=time.strftime('updated %H:%M', time.localtime(entry.fetched_at)),
+        **parse_weather(entry.json(), unit))
+
+
+async def weather_handler(cache, url, weather_state, unit='celsius', ttl=600,
+                          interval=60, awake=None):
+    # The cache answers most polls, at most one request per ttl reaches the
+    # network and a failed one keeps showing the last good response. With
+    # awake given, polling pauses while the event is clear.
+    while True:
+        if awake is not None:
+            await awake.wait()
+        try:
+            entry = await cache.get(
+                url, ttl, on_update=lambda: apply_weather(
+                    weather_state, cache.peek(url), unit))
+            apply_weather(weather_state, entry, unit)
+        except Exception:
+            logging.error(traceback.format_exc())
+        await asyncio.sleep(interval)
@@ -0,0 +1,249 @@
+"""Screens composed from independently refreshed widgets.
+
+A widget owns a box of the screen and draws it as 8 bit coverage from a few
+fields of a State, optionally on a timer as well. A Compositor keeps each
+widget's last layer and the composed canvas, so a frame only redraws the
+widgets whose data changed and recomposes their boxes. The canvas is
+published as a (coverage, color) pair, and the driver's partial update then
+sends only what changed on the panel.
+"""
+import calendar
+import threading
+import time
+from datetime import date
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from text_metrics import text_dims
+
+
+class Widget:
+    """Base class, subclasses implement draw(draw, values).
+
+    box is (x0, y0, x1, y1) in screen pixels. The widget is redrawn when one
+    of keys changes in state and, with interval set, every interval seconds.
+    values is a plain dict of those keys, snapshotted on the event loop.
+    """
+
+    def __init__(self, box, state=None, keys=(), interval=None):
+        self.box = box
+        self.state = state
+        self.keys = keys
+        self.interval = interval
+
+    @property
+    def size(self):
+        x0, y0, x1, y1 = self.box
+        return x1 - x0, y1 - y0
+
+    def version(self):
+        if self.state is None:
+            return 0
+        return self.state.version_of(*self.keys)
+
+    def values(self):
+        return {key: self.state.get(key) for key in self.keys}
+
+    def render(self, values):
+        layer = Image.new('L', self.size, 0)
+        self.draw(ImageDraw.Draw(layer), values)
+        return np.asarray(layer)
+
+    def draw(self, draw, values):
+        raise NotImplementedError
+
+
+class TextWidget(Widget):
+    """One line of text, text(values) builds the string"""
+
+    def __init__(self, box, state, keys, text, font, align='left'):
+        super().__init__(box, state, keys)
+        self.text = text
+        self.font = font
+        self.align = align
+
+    def draw(self, draw, values):
+        text = self.text(values)
+        x_pos = 0
+        if self.align == 'center':
+            x_pos = (self.size[0] - text_dims(self.font, text)[1]) // 2
+        draw.text((x_pos, 0), text, font=self.font, fill=255)
+
+
+class SparklineWidget(Widget):
+    """History plot scrolling left, one column per sample.
+
+    key in state counts the samples taken and history(n) returns the newest
+    n of them. A redraw shifts the existing plot by the number of new
+    samples and only draws their columns.
+    """
+
+    def __init__(self, box, state, key, history, low, high):
+        super().__init__(box, state, (key,))
+        self.history = history
+        self.low = low
+        self.high = high
+        width, height = self.size
+        self._plot = np.zeros((height, width), dtype=np.uint8)
+        self._rows = np.arange(height)[:, None]
+        self._drawn = 0
+
+    def values(self):
+        values = super().values()
+        values['history'] = self.history(self.size[0])
+        return values
+
+    def render(self, values):
+        count = values[self.keys[0]] or 0
+        new = min(count - self._drawn, self.size[0])
+        self._drawn = count
+        if new <= 0:
+            return self._plot
+
+        plot = self._plot
+        height = plot.shape[0]
+        plot[:, :-new] = plot[:, new:]
+        scaled = (values['history'][-new:] - self.low) / (self.high - self.low)
+        top = height - 1 - np.clip(np.round(scaled * (height - 1)),
+                                   0, height - 1).astype(int)
+        # bright line on a dim fill
+        plot[:, -new:] = np.where(self._rows > top, 64,
+                                  np.where(self._rows == top, 255, 0))
+        return plot
+
+
+class MonthWidget(Widget):
+    """Month grid, Monday first, with a bar under days that have events.
+
+    Drawn from a (year, month) key and a set of busy day numbers, so the
+    layer is rebuilt only when the month or the days with events change.
+    """
+
+    def __init__(self, box, state, month_key, busy_key, font, row_height=18):
+        super().__init__(box, state, (month_key, busy_key))
+        self.font = font
+        self.row_height = row_height
+        self.cell_width = self.size[0] // 7
+
+    def cell(self, year, month, day):
+        """Box of a day within the widget, or None if it is not shown"""
+        for row, week in enumerate(calendar.monthcalendar(year, month)):
+            if day in week:
+                x0 = week.index(day) * self.cell_width
+                y0 = (row + 2) * self.row_height
+                return x0, y0, x0 + self.cell_width, y0 + self.row_height
+        return None
+
+    def _centered(self, draw, x0, y0, text, fill):
+        x_pos = x0 + (self.cell_width - text_dims(self.font, text)[1]) // 2
+        draw.text((x_pos, y0), text, font=self.font, fill=fill)
+
+    def draw(self, draw, values):
+        month_key, busy_key = self.keys
+        if values[month_key] is None:
+            return
+        year, month = values[month_key]
+        busy = values[busy_key] or ()
+        draw.text((2, 0), date(year, month, 1).strftime('%B %Y'),
+                  font=self.font, fill=255)
+        for col, name in enumerate('MTWTFSS'):
+            self._centered(draw, col * self.cell_width, self.row_height,
+                           name, 128)
+        for row, week in enumerate(calendar.monthcalendar(year, month)):
+            y0 = (row + 2) * self.row_height
+            for col, day in enumerate(week):
+                if not day:
+                    continue
+                x0 = col * self.cell_width
+                self._centered(draw, x0, y0, str(day), 255)
+                if day in busy:
+                    y_line = y0 + self.row_height - 2
+                    draw.line((x0 + 6, y_line, x0 + self.cell_width - 6,
+                               y_line), fill=255)
+
+
+class DayMarker(Widget):
+    """Outline around one day of a MonthWidget, drawn as its own layer"""
+
+    def __init__(self, month, day_key):
+        super().__init__(month.box, month.state, month.keys[:1] + (day_key,))
+        self.month = month
+
+    def draw(self, draw, values):
+        month_key, day_key = self.keys
+        day = values[day_key]
+        if day is None or values[month_key] != (day.year, day.month):
+            return
+        x0, y0, x1, y1 = self.month.cell(day.year, day.month, day.day)
+        draw.rectangle((x0, y0, x1 - 1, y1 - 1), outline=255)
+
+
+class Compositor:
+    """Layered screen of widgets, later widgets drawn over earlier ones.
+
+    update() runs on the event loop and queues the widgets that are due.
+    compose() runs on the render thread and redraws everything queued since
+    the last call, so a publish dropped by the pipeline loses nothing.
+    """
+
+    def __init__(self, width=320, height=240):
+        self.canvas = np.zeros((height, width), dtype=np.uint8)
+        self.widgets = []
+        self.layers_rendered = 0
+        self._layers = {}
+        self._scheduled = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def add(self, widget):
+        self.widgets.append(widget)
+        return widget
+
+    def invalidate(self):
+        """Redraw every widget on the next update"""
+        self._scheduled.clear()
+
+    def update(self, now=None):
+        """Queue the widgets that are due, returns True if any are pending"""
+        if now is None:
+            now = time.monotonic()
+        due = {}
+        for widget in self.widgets:
+            version = widget.version()
+            last = self._scheduled.get(widget)
+            if (last is None or last[0] != version or
+                    (widget.interval and now - last[1] >= widget.interval)):
+                self._scheduled[widget] = (version, now)
+                due[widget] = widget.values()
+        with self._lock:
+            self._pending.update(due)
+            return bool(self._pending)
+
+    def compose(self):
+        """Redraw the pending widgets and return the canvas"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        for widget, values in pending.items():
+            self._layers[widget] = widget.render(values)
+            self.layers_rendered += 1
+        for widget in pending:
+            self._recompose(widget.box)
+        return self.canvas
+
+    def _recompose(self, box):
+        # text on black, so overlapping layers combine by maximum coverage
+        x0, y0, x1, y1 = box
+        self.canvas[y0:y1, x0:x1] = 0
+        for widget in self.widgets:
+            layer = self._layers.get(widget)
+            if layer is None:
+                continue
+            wx0, wy0, wx1, wy1 = widget.box
+            ix0, iy0 = max(x0, wx0), max(y0, wy0)
+            ix1, iy1 = min(x1, wx1), min(y1, wy1)
+            if ix0 >= ix1 or iy0 >= iy1:
+                continue
+            region = self.canvas[iy0:iy1, ix0:ix1]
+            np.maximum(region, layer[iy0 - wy0:iy1 - wy0, ix0 - wx0:ix1 - wx0],
+                       out=region)